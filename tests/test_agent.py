@@ -0,0 +1,112 @@
+from vce.agent import TcHash, merge_config
+
+
+def test_merge_config():
+    config = {'a': {'delay': 1.0}, 'b': {'loss': 100}}
+    changes = {'b': {'delay': 3.0}, 'c': {'loss': 100}, 'a': None}
+    merged = merge_config(config, changes)
+    assert merged == {'b': {'delay': 3.0}, 'c': {'loss': 100}}
+    assert config == {'a': {'delay': 1.0}, 'b': {'loss': 100}}
+
+
+def queued(tc):
+    """Get and clear the commands queued by a `TcBatch`."""
+    commands, tc.commands = tc.commands, []
+    return commands
+
+
+def test_tc_hash_layout():
+    tc = TcHash('eth0', '10.0.0.1')
+    assert queued(tc) == [
+        'qdisc add dev eth0 root handle 1: htb default 1',
+        'class add dev eth0 parent 1: classid 1:1 htb rate 10gbit',
+        'filter add dev eth0 parent 1: prio 1 handle 2: protocol ip '
+        'u32 divisor 256',
+        'filter add dev eth0 parent 1: protocol ip prio 1 handle 800::2 '
+        'u32 ht 800:: match ip src 10.0.0.1/32 '
+        'hashkey mask 0x0000ff00 at 16 link 2:']
+
+
+def test_tc_hash_add():
+    tc = TcHash('eth0', '10.0.0.1')
+    queued(tc)
+    tc.set('10.0.1.5', {'delay': 10.0})
+    assert queued(tc) == [
+        'class add dev eth0 parent 1: classid 1:3 htb rate 10gbit',
+        'qdisc add dev eth0 parent 1:3 handle 3: netem delay 10ms',
+        'filter add dev eth0 parent 1: prio 1 handle 101: protocol ip '
+        'u32 divisor 256',
+        'filter add dev eth0 parent 1: protocol ip prio 1 handle 2:1:1 '
+        'u32 ht 2:1: match u32 0 0 hashkey mask 0x000000ff at 16 '
+        'link 101:',
+        'filter add dev eth0 parent 1: protocol ip prio 1 '
+        'handle 101:5:1 u32 ht 101:5: match ip dst 10.0.1.5/32 '
+        'flowid 1:3']
+
+    # same parameters, no commands
+    tc.set('10.0.1.5', {'delay': 10.0})
+    assert queued(tc) == []
+
+    # another /16 network sharing a bucket
+    tc.set('10.1.1.5', {'delay': 20.0})
+    assert queued(tc)[-1] == (
+        'filter add dev eth0 parent 1: protocol ip prio 1 '
+        'handle 101:5:2 u32 ht 101:5: match ip dst 10.1.1.5/32 '
+        'flowid 1:4')
+
+
+def test_tc_hash_share_and_change():
+    tc = TcHash('eth0', '10.0.0.1')
+    tc.set('10.0.1.5', {'delay': 10.0})
+    queued(tc)
+
+    # delays rounded to microseconds share a class
+    tc.set('10.0.2.5', {'delay': 10.0004})
+    assert queued(tc)[-1] == (
+        'filter add dev eth0 parent 1: protocol ip prio 1 '
+        'handle 102:5:1 u32 ht 102:5: match ip dst 10.0.2.5/32 '
+        'flowid 1:3')
+
+    # a shared class is left to the other destination
+    tc.set('10.0.1.5', {'delay': 15.0, 'loss': 1})
+    assert queued(tc) == [
+        'class add dev eth0 parent 1: classid 1:4 htb rate 10gbit',
+        'qdisc add dev eth0 parent 1:4 handle 4: netem delay 15ms loss 1%',
+        'filter replace dev eth0 parent 1: protocol ip prio 1 '
+        'handle 101:5:1 u32 ht 101:5: match ip dst 10.0.1.5/32 '
+        'flowid 1:4']
+
+    # a class with a single destination is changed in place
+    tc.set('10.0.2.5', {'delay': 20.0})
+    assert queued(tc) == [
+        'qdisc change dev eth0 parent 1:3 handle 3: netem delay 20ms']
+
+
+def test_tc_hash_remove():
+    tc = TcHash('eth0', '10.0.0.1')
+    tc.set('10.0.1.5', {'delay': 10.0})
+    tc.set('10.0.2.5', {'delay': 10.0})
+    queued(tc)
+
+    # shared class kept while used
+    tc.remove('10.0.1.5')
+    assert queued(tc) == [
+        'filter del dev eth0 parent 1: protocol ip prio 1 '
+        'handle 101:5:1 u32']
+    tc.remove('10.0.2.5')
+    assert queued(tc) == [
+        'filter del dev eth0 parent 1: protocol ip prio 1 '
+        'handle 102:5:1 u32',
+        'qdisc del dev eth0 parent 1:3 handle 3:',
+        'class del dev eth0 classid 1:3']
+    tc.remove('10.0.2.5')
+    assert queued(tc) == []
+
+    # filter handles and class ids are reused
+    tc.set('10.0.1.5', {'delay': 30.0})
+    assert queued(tc) == [
+        'class add dev eth0 parent 1: classid 1:3 htb rate 10gbit',
+        'qdisc add dev eth0 parent 1:3 handle 3: netem delay 30ms',
+        'filter add dev eth0 parent 1: protocol ip prio 1 '
+        'handle 101:5:1 u32 ht 101:5: match ip dst 10.0.1.5/32 '
+        'flowid 1:3']
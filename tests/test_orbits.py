@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+import numpy as np
+from vce.orbits import axes, speed, ecef_array, geodetic_array, \
+    pair_latencies, sight_latencies, link_latencies, grid_positions, \
+    interpolate_positions, nanoseconds
+
+
+def sight_latency(p1, p2):
+    """Scalar line-of-sight latency of the original implementation."""
+    p1, p2 = np.array(p1), np.array(p2)
+    dist = np.linalg.norm(p1-p2)
+    if dist < 5:
+        return 0.0
+    s1, s2 = p1/axes, p2/axes
+    s12 = s1-s2
+    a = np.dot(s12, s12)
+    b = np.sum(np.dot(s12, s2))*2
+    c = np.dot(s2, s2)-1
+    d = b**2 - 4*a*c
+    if d < 0.0:
+        return dist/speed*1000
+    q = (-b-np.sign(b)*np.sqrt(d))/2
+    sol1, sol2 = q/a, c/q
+    if (sol1 < 0.0 or sol1 > 1.0) and (sol2 < 0.0 or sol2 > 1.0):
+        return dist/speed*1000
+    return None
+
+
+def random_positions(count, seed=0):
+    """ECEF positions of satellites at random coordinates (in LEO, away
+    from the surface of the ellipsoid)."""
+    rng = np.random.default_rng(seed)
+    return ecef_array(rng.uniform(-90, 90, count),
+                      rng.uniform(-180, 180, count),
+                      rng.uniform(3e5, 2e6, count))
+
+
+def test_pair_latencies():
+    p1, p2 = random_positions(500, 1), random_positions(500, 2)
+    expected = [sight_latency(a, b) for a, b in zip(p1, p2)]
+    expected = np.array([np.nan if v is None else v for v in expected])
+    latency = pair_latencies(p1, p2)
+    assert np.isnan(expected).any() and not np.isnan(expected).all()
+    np.testing.assert_array_equal(np.isnan(latency), np.isnan(expected))
+    np.testing.assert_allclose(latency, expected, rtol=1e-12)
+    np.testing.assert_array_equal(latency, pair_latencies(p2, p1))
+
+
+def test_sight_latencies():
+    pos = random_positions(60)
+    latency = sight_latencies(pos)
+    for i in range(len(pos)):
+        for j in range(len(pos)):
+            expected = sight_latency(pos[i], pos[j])
+            if expected is None:
+                assert np.isnan(latency[i, j])
+            else:
+                assert np.isclose(latency[i, j], expected, rtol=1e-12)
+
+
+def test_sight_latencies_pairs():
+    pos = random_positions(60)
+    pairs = (np.array([0, 1, 5, 7]), np.array([3, 2, 9, 40]))
+    latency = sight_latencies(pos, pairs)
+    full = sight_latencies(pos)
+    i, j = pairs
+    np.testing.assert_array_equal(latency[i, j], full[i, j])
+    np.testing.assert_array_equal(latency[j, i], full[j, i])
+    np.testing.assert_array_equal(link_latencies(pos, pairs), full[i, j])
+    linked = np.zeros_like(latency, dtype=bool)
+    linked[i, j] = linked[j, i] = True
+    np.fill_diagonal(linked, True)
+    assert np.isnan(latency[~linked]).all()
+
+
+def test_ecef_geodetic_roundtrip():
+    rng = np.random.default_rng(3)
+    lat = rng.uniform(-89.9, 89.9, 1000)
+    lon = rng.uniform(-179.9, 179.9, 1000)
+    alt = rng.uniform(0, 4e7, 1000)
+    lat2, lon2, alt2 = geodetic_array(ecef_array(lat, lon, alt))
+    np.testing.assert_allclose(lat2, lat, atol=1e-9)
+    np.testing.assert_allclose(lon2, lon, atol=1e-9)
+    np.testing.assert_allclose(alt2, alt, atol=1e-3)
+
+
+def test_grid_positions():
+    start, step = datetime(2019, 2, 15, 13, 50), timedelta(minutes=1)
+    t0, dt = nanoseconds(start), nanoseconds(step)
+    series = [
+        ('a', np.array([t0, t0 + dt, t0 + 3*dt]),
+         np.array([[1., 2., 3.], [4., 5., 6.], [7., 8., 9.]])),
+        # points before the start and between steps
+        ('b', np.array([t0 - dt, t0 + dt + dt//2]),
+         np.array([[0., 0., 0.], [1., 1., 1.]])),
+        ('unknown', np.array([t0]), np.array([[9., 9., 9.]])),
+    ]
+    lat, lon, alt = grid_positions(series, ['a', 'b', 'c'], start, step, 5)
+    np.testing.assert_array_equal(lat[:, 0], [1, 4, 4, 7, 7])
+    np.testing.assert_array_equal(alt[:, 0], [3, 6, 6, 9, 9])
+    np.testing.assert_array_equal(lon[:, 1], [0, 0, 1, 1, 1])
+    assert np.isnan(lat[:, 2]).all()
+
+
+def test_interpolate_positions():
+    # positions on a quadratic trajectory are interpolated exactly
+    t = np.arange(6, dtype=float)
+    positions = np.stack([t, t**2, 2*t + 1], axis=-1)[:, None, :]
+    np.testing.assert_allclose(interpolate_positions(positions, 2),
+                               positions[2])
+    np.testing.assert_allclose(interpolate_positions(positions, 2.5),
+                               [[2.5, 2.5**2, 6]])
+    np.testing.assert_allclose(interpolate_positions(positions, 5),
+                               positions[5])
+    np.testing.assert_allclose(interpolate_positions(positions[:1], 0.5),
+                               positions[0])
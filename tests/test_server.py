@@ -0,0 +1,17 @@
+from vce.server import diff_params
+from vce.agent import merge_config
+
+
+def test_diff_params():
+    old = {'a': {'delay': 1.0}, 'b': {'loss': 100}, 'c': {'delay': 2.0}}
+    new = {'a': {'delay': 1.0}, 'b': {'delay': 3.0}, 'd': {'loss': 100}}
+    assert diff_params(old, new) == {'b': {'delay': 3.0}, 'c': None,
+                                     'd': {'loss': 100}}
+    assert diff_params(new, new) == {}
+    assert diff_params({}, new) == new
+
+
+def test_diff_merge_roundtrip():
+    old = {'a': {'delay': 1.0}, 'b': {'loss': 100}, 'c': {'delay': 2.0}}
+    new = {'a': {'delay': 1.5}, 'c': {'delay': 2.0}, 'd': {'loss': 100}}
+    assert merge_config(old, diff_params(old, new)) == new
@@ -1,6 +1,7 @@
 """VCE agent running on each node (satellite or base station)."""
 
 import time
+import json
 import logging
 import platform
 import subprocess
@@ -8,7 +9,9 @@ import click
 import requests
 import pprint
 import sys
-from .utils import log_enabled, parse, host_alias, get_addr, get_iface
+from itertools import chain
+from .utils import log_enabled, parse, host_alias, get_addr, get_iface, \
+    get_links, host_addresses
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +22,12 @@ def agent():
     pass
 
 
+def format_value(value):
+    """Format a parameter value without trailing zeros."""
+
+    return str(float(value)).rstrip('0').rstrip('.')
+
+
 def apply_config(iface, src, dst, config):
     """Apply changes to network configuration."""
 
@@ -27,7 +36,7 @@ def apply_config(iface, src, dst, config):
                '--dst-network', f'{dst}']
 
     for key, value in config.items():
-        value = str(float(value)).rstrip('0').rstrip('.')
+        value = format_value(value)
         if key == 'delay':
             command.append('--delay')
             command.append(f'{value}ms')
@@ -44,24 +53,454 @@ def apply_config(iface, src, dst, config):
             raise ValueError('Unknown parameter {key}')
 
     # apply parameters in a subprocess
+    run_command(command)
+
+
+def remove_config(iface, src, dst):
+    """Remove the network configuration of a destination."""
+
+    run_command(['tcdel', iface,
+                 '--src-network', f'{src}',
+                 '--dst-network', f'{dst}'])
+
+
+def netem_args(config):
+    """Get the arguments of a netem qdisc applying a configuration."""
+
+    args = []
+    for key, value in config.items():
+        value = format_value(value)
+        if key == 'delay':
+            args += ['delay', f'{value}ms']
+        elif key == 'rate':
+            args += ['rate', f'{value}kbit']
+        elif key == 'loss':
+            args += ['loss', f'{value}%']
+        elif key == 'corrupt':
+            args += ['corrupt', f'{value}%']
+        else:
+            raise ValueError(f'Unknown parameter {key}')
+    return ' '.join(args)
+
+
+class TcBatch:
+    """Network configuration applied with a single `tc -batch` process.
+
+    The root HTB qdisc of the interface has a class with a netem qdisc
+    for each destination, selected by a u32 filter on source and
+    destination addresses (other packets go to the default class).
+    Class ids and filter handles of removed destinations are reused;
+    u32 filter handles limit destinations to 4094 (see `TcHash`).
+    Commands are queued and run together by `apply`.
+    """
+
+    #: Rate of HTB classes (netem applies rate limits)
+    rate = '10gbit'
+
+    #: Largest u32 filter node id (12 bits)
+    max_node = 0xfff
+
+    def __init__(self, iface, src):
+        self.iface, self.src = iface, src
+        self.classes = {}  # class minor id by destination address
+        self.filters = {}  # filter node id by destination address
+        self.free, self.next_minor = [], 3
+        self.free_nodes, self.next_node = [], 2
+        self.reset = True
+        self.commands = [f'qdisc add dev {iface} root handle 1: htb '
+                         f'default 1',
+                         f'class add dev {iface} parent 1: classid 1:1 '
+                         f'htb rate {self.rate}']
+
+    def drop_unlinked(self, network, server):
+        """Drop all packets to a network, except those to the server
+        (filters of destinations take precedence)."""
+
+        # filters with priority 1 are added first, to get hash table 800:
+        dev = f'dev {self.iface}'
+        self.commands += [
+            f'class add {dev} parent 1: classid 1:2 htb rate {self.rate}',
+            f'qdisc add {dev} parent 1:2 handle 2: netem loss 100%',
+            f'filter add {dev} parent 1: protocol ip prio 1 handle 800::1 '
+            f'u32 match ip dst {server}/32 flowid 1:1',
+            f'filter add {dev} parent 1: protocol ip prio 2 u32 '
+            f'match ip src {self.src}/32 match ip dst {network} flowid 1:2']
+
+    def add_class(self, netem):
+        """Queue commands adding a class with a netem qdisc, and return
+        its minor id (hex)."""
+
+        if self.free:
+            minor = self.free.pop()
+        else:
+            minor, self.next_minor = f'{self.next_minor:x}', \
+                self.next_minor + 1
+        dev = f'dev {self.iface}'
+        self.commands += [
+            f'class add {dev} parent 1: classid 1:{minor} '
+            f'htb rate {self.rate}',
+            f'qdisc add {dev} parent 1:{minor} handle {minor}: '
+            f'netem {netem}']
+        return minor
+
+    def change_class(self, minor, netem):
+        """Queue a command changing the netem qdisc of a class."""
+
+        self.commands.append(f'qdisc change dev {self.iface} '
+                             f'parent 1:{minor} handle {minor}: '
+                             f'netem {netem}')
+
+    def del_class(self, minor):
+        """Queue commands deleting a class and its netem qdisc."""
+
+        dev = f'dev {self.iface}'
+        self.commands += [
+            f'qdisc del {dev} parent 1:{minor} handle {minor}:',
+            f'class del {dev} classid 1:{minor}']
+        self.free.append(minor)
+
+    def set(self, dst, config):
+        """Queue commands setting the configuration of a destination."""
+
+        minor = self.classes.get(dst)
+        if minor is not None:
+            self.change_class(minor, netem_args(config))
+            return
+
+        if self.free_nodes:
+            node = self.free_nodes.pop()
+        elif self.next_node <= self.max_node:
+            node, self.next_node = f'{self.next_node:x}', self.next_node + 1
+        else:
+            raise ValueError(f'Too many destinations for the batch tc mode '
+                             f'(up to {self.max_node - 1}), use hash')
+        minor = self.classes[dst] = self.add_class(netem_args(config))
+        self.filters[dst] = node
+        self.commands.append(
+            f'filter add dev {self.iface} parent 1: protocol ip prio 1 '
+            f'handle 800::{node} u32 match ip src {self.src}/32 '
+            f'match ip dst {dst}/32 flowid 1:{minor}')
+
+    def remove(self, dst):
+        """Queue commands removing the configuration of a destination."""
+
+        minor = self.classes.pop(dst, None)
+        if minor is None:
+            return
+        node = self.filters.pop(dst)
+        self.commands.append(f'filter del dev {self.iface} parent 1: '
+                             f'protocol ip prio 1 handle 800::{node} u32')
+        self.del_class(minor)
+        self.free_nodes.append(node)
+
+    def apply(self):
+        """Run the queued commands in a single tc process (removing any
+        previous root qdisc the first time)."""
+
+        if self.reset:
+            # fails on interfaces without a root qdisc
+            subprocess.run(['tc', 'qdisc', 'del', 'dev', self.iface, 'root'],
+                           capture_output=True)
+            self.reset = False
+        if self.commands:
+            run_command(['tc', '-force', '-batch', '-'],
+                        '\n'.join(self.commands) + '\n')
+            self.commands = []
+
+
+class TcHash(TcBatch):
+    """Network configuration applied with a single `tc -batch` process,
+    classifying packets with hashed u32 filters.
+
+    Packets from the source address are looked up in a hash table on
+    the third octet of the destination address, linked to hash tables
+    on the fourth octet, so that classification cost does not grow
+    with the number of destinations. Destinations with the same
+    parameters (delays rounded to microseconds) share a class with a
+    netem qdisc.
+    """
+
+    def __init__(self, iface, src):
+        super().__init__(iface, src)
+        self.tables = set()  # third octets with a hash table
+        self.handles = {}  # filter handle by destination address
+        self.used = set()  # filter handles of destinations
+        self.params = {}  # netem arguments by destination address
+        self.shared = {}  # [class minor id, destinations] by netem arguments
+        dev = f'dev {iface}'
+        self.commands += [
+            f'filter add {dev} parent 1: prio 1 handle 2: protocol ip '
+            f'u32 divisor 256',
+            f'filter add {dev} parent 1: protocol ip prio 1 handle 800::2 '
+            f'u32 ht 800:: match ip src {src}/32 '
+            f'hashkey mask 0x0000ff00 at 16 link 2:']
+
+    def filter_handle(self, dst):
+        """Get an unused filter handle for a destination address, in the
+        hash tables of its third and fourth octets (queueing commands
+        adding the fourth octet table, if missing)."""
+
+        third, fourth = (int(octet) for octet in dst.split('.')[2:])
+        table = f'{0x100 + third:x}'
+        if third not in self.tables:
+            self.tables.add(third)
+            dev = f'dev {self.iface}'
+            self.commands += [
+                f'filter add {dev} parent 1: prio 1 handle {table}: '
+                f'protocol ip u32 divisor 256',
+                f'filter add {dev} parent 1: protocol ip prio 1 '
+                f'handle 2:{third:x}:1 u32 ht 2:{third:x}: match u32 0 0 '
+                f'hashkey mask 0x000000ff at 16 link {table}:']
+
+        # destinations of other /16 networks may share a bucket
+        node = 1
+        while f'{table}:{fourth:x}:{node:x}' in self.used:
+            node += 1
+        self.used.add(f'{table}:{fourth:x}:{node:x}')
+        return f'{table}:{fourth:x}:{node:x}'
+
+    def set(self, dst, config):
+        """Queue commands setting the configuration of a destination."""
+
+        if 'delay' in config:
+            config = dict(config, delay=round(float(config['delay']), 3))
+        netem, old = netem_args(config), self.params.get(dst)
+        if netem == old:
+            return
+
+        # change the class of a single destination in place
+        if old is not None and self.shared[old][1] == 1 and \
+                netem not in self.shared:
+            self.shared[netem] = self.shared.pop(old)
+            self.params[dst] = netem
+            self.change_class(self.shared[netem][0], netem)
+            return
+
+        if netem not in self.shared:
+            self.shared[netem] = [self.add_class(netem), 0]
+        self.shared[netem][1] += 1
+        self.params[dst] = netem
+
+        handle = self.handles.get(dst)
+        command = 'replace'
+        if handle is None:
+            handle = self.handles[dst] = self.filter_handle(dst)
+            command = 'add'
+        self.commands.append(
+            f'filter {command} dev {self.iface} parent 1: protocol ip '
+            f'prio 1 handle {handle} u32 ht {handle.rsplit(":", 1)[0]}: '
+            f'match ip dst {dst}/32 flowid 1:{self.shared[netem][0]}')
+        if old is not None:
+            self.unshare(old)
+
+    def remove(self, dst):
+        """Queue commands removing the configuration of a destination."""
+
+        handle = self.handles.pop(dst, None)
+        if handle is None:
+            return
+        self.used.discard(handle)
+        self.commands.append(f'filter del dev {self.iface} parent 1: '
+                             f'protocol ip prio 1 handle {handle} u32')
+        self.unshare(self.params.pop(dst))
+
+    def unshare(self, netem):
+        """Release a class shared by destinations with the given netem
+        arguments, deleting it when no longer used."""
+
+        self.shared[netem][1] -= 1
+        if not self.shared[netem][1]:
+            self.del_class(self.shared.pop(netem)[0])
+
+
+def run_command(command, input=None):
+    """Run a network configuration command in a subprocess (with the
+    given standard input)."""
+
     try:
-        subprocess.run(command, capture_output=True, check=True)
+        subprocess.run(command, input=input and input.encode(),
+                       capture_output=True, check=True)
     except subprocess.CalledProcessError as e:
-        print(f'Error invoking: {" ".join(e.cmd)}\n{e.stdout}')
+        print(f'Error invoking: {" ".join(e.cmd)}\n'
+              f'{e.stdout.decode()}{e.stderr.decode()}')
     except FileNotFoundError as e:
         print(f'Command unknown: {e}')
 
 
-def polling(src_host, server, period):
+#: Time of the next lookup and backoff interval of unresolved hostnames
+lookup_retries = {}
+
+
+def resolve(addresses, hostname):
+    """Get the ip address of a hostname from a table of addresses,
+    resolving and adding hostnames missing from the table (None if it
+    cannot be resolved). Failed lookups are not cached, but retried
+    after a backoff interval (doubling up to a minute)."""
+
+    if hostname in addresses:
+        return addresses[hostname]
+
+    retry, interval = lookup_retries.get(hostname, (0, 0))
+    if time.time() < retry:
+        return None
+
+    addr = get_addr(host_alias(hostname))
+    if addr:
+        addresses[hostname] = addr
+        lookup_retries.pop(hostname, None)
+    else:
+        interval = min(max(2*interval, 1), 60)
+        lookup_retries[hostname] = (time.time() + interval, interval)
+        logger.error(f'Cannot resolve hostname {hostname} '
+                     f'(retrying in {interval}s)')
+    return addr
+
+
+def update_config(iface, src, net_config, last_net_config, tc=None,
+                  addresses=None):
+    """Apply a network configuration received from the server, and
+    return the configuration in use.
+
+    Only destinations with parameters that differ from the last
+    configuration are updated, and rules of destinations missing from
+    the new configuration are removed (in a single batch with a
+    `TcBatch`). Addresses of destinations are taken from the table of
+    `addresses`; destinations that cannot be resolved are skipped and
+    left out of the returned configuration (see `pending`).
+    """
+    addresses = {} if addresses is None else addresses
+
+    if log_enabled('INFO'):
+        logger.info('Received configurations:\n' +
+                    pprint.pformat(net_config, indent=2))
+
+    # apply only changed destinations
+    changed = {dst_host: config for dst_host, config in net_config.items()
+               if last_net_config.get(dst_host) != config}
+    removed = [dst_host for dst_host in last_net_config
+               if dst_host not in net_config]
+
+    net_config = dict(net_config)
+    for dst_host in chain(changed, removed):
+        dst = resolve(addresses, dst_host)
+        if not dst:
+            net_config.pop(dst_host, None)
+        elif dst_host in changed and tc:
+            tc.set(dst, changed[dst_host])
+        elif dst_host in changed:
+            apply_config(iface, src, dst, changed[dst_host])
+        elif tc:
+            tc.remove(dst)
+        else:
+            remove_config(iface, src, dst)
+
+    if tc and (changed or removed):
+        tc.apply()
+    return net_config
+
+
+def pending(net_config, last_net_config):
+    """Get the destinations of a network configuration that were left out
+    of the configuration in use (their hostnames could not be resolved),
+    to be retried with the next full configuration."""
+
+    return [dst_host for dst_host in net_config
+            if dst_host not in last_net_config]
+
+
+def merge_config(net_config, changes):
+    """Merge changes received from the server into a network
+    configuration (None for removed destinations)."""
+
+    net_config = dict(net_config)
+    for dst_host, config in changes.items():
+        if config is None:
+            net_config.pop(dst_host, None)
+        else:
+            net_config[dst_host] = config
+    return net_config
+
+
+def subscribe(url, keepalive=60):
+    """Yield versions and network configurations pushed by the server
+    as server-sent events, until the connection is closed (or nothing is
+    received for 10 seconds more than the `keepalive` interval of the
+    server, in seconds)."""
+
+    with requests.get(url, stream=True, timeout=(10, keepalive + 10)) as r:
+        r.raise_for_status()
+        version = None
+        for line in r.iter_lines():
+            if line.startswith(b'id:'):
+                version = line[3:].strip().decode()
+            elif line.startswith(b'data:'):
+                yield version, json.loads(line[5:])
+
+
+def follow_schedule(url, iface, src, tc=None, addresses=None):
+    """Download the network configurations of all time steps from the
+    server, and apply changes at the start of each time step (changes
+    of time steps already started are applied together). Returns the
+    last configuration applied."""
+
+    r = requests.get(url)
+    r.raise_for_status()
+    schedule = r.json()
+    start, step, changes = schedule['start'], schedule['step'], \
+        schedule['changes']
+    logger.info(f'Received {len(changes)} changes of {schedule["ticks"]} '
+                f'time steps')
+
+    net_config, last_net_config = {}, {}
+    for k, (tick, tick_changes) in enumerate(changes):
+        net_config = merge_config(net_config, tick_changes)
+        if k + 1 < len(changes) and \
+                start + changes[k+1][0]*step <= time.time():
+            continue
+
+        wait = start + tick*step - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        last_net_config = update_config(iface, src, net_config,
+                                        last_net_config, tc, addresses)
+    return last_net_config
+
+
+def polling(src_host, server, period, push=False, network=None,
+            port=8888, tc_mode='tcset', addresses=None, schedule=False,
+            keepalive=60):
     """Poll the server with /net/src/host queries and
     apply network configurations using `tcconfig`.
 
+    With `push`, hold a connection open to /net/src/host/stream and
+    apply configurations as they change, falling back to polling
+    while the connection fails (or stays silent for longer than the
+    `keepalive` interval of the server, in seconds).
+
+    With `network` (sparse topologies), packets to destinations of the
+    network without parameters from the server are dropped. This needs
+    the 'batch' or 'hash' `tc_mode`: tcconfig gives all its filters the
+    same priority, so a network rule would shadow destination rules.
+
+    With the 'batch' `tc_mode`, changes are applied by a single `tc`
+    process instead of a `tcset` process for each destination; the
+    'hash' mode also classifies packets with hashed filters.
+
+    Hostnames are resolved with the table of `addresses` (hostnames
+    missing from the table are resolved and added to it).
+
+    With `schedule`, download configurations of all time steps from
+    /net/src/host/schedule once and apply them at the start of each
+    time step, without polling (clocks should be synchronized); polling
+    starts after the last change of the schedule.
+
     To run without root privileges:
     `sudo setcap cap_net_admin+ep /sbin/tc`
     """
 
     # ip address and network interface of this node
-    src = get_addr(host_alias(src_host))
+    addresses = {} if addresses is None else addresses
+    src = resolve(addresses, src_host)
     if not src:
         raise ValueError(f'Cannot resolve hostname {src_host}')
 
@@ -69,33 +508,68 @@ def polling(src_host, server, period):
     if not iface:
         raise ValueError(f'Cannot find interface of {src}')
 
+    tc = {'batch': TcBatch, 'hash': TcHash}.get(tc_mode)
+    tc = tc(iface, src) if tc else None
+    if network and not tc:
+        raise ValueError('Sparse topologies need the batch or hash tc mode')
+    if network:
+        server_addr = resolve(addresses, server)
+        if not server_addr:
+            raise ValueError(f'Cannot resolve hostname {server}')
+        tc.drop_unlinked(network, server_addr)
+    if tc:
+        tc.apply()
+
     # server url to obtain outgoing network parameters
-    url = f'http://{server}:8888/net/src/{src_host}'
+    url = f'http://{host_alias(server)}:{port}/net/src/{src_host}'
+    last_net_config, version = {}, None
+    if schedule:
+        try:
+            last_net_config = follow_schedule(f'{url}/schedule', iface, src,
+                                              tc, addresses)
+            logger.info('Schedule completed, polling instead')
+        except requests.exceptions.RequestException as e:
+            logger.warning(f'Schedule failed, polling instead: {e}')
 
-    last_net_config = {}
     while True:
         try:
-            r = requests.get(url)
-            net_config = r.json()
-            if log_enabled('INFO'):
-                logger.info('Received configurations:\n' +
-                            pprint.pformat(net_config, indent=2))
-
-            # apply only when configuration changed
-            if net_config != last_net_config:
-                for dst_host, config in net_config.items():
-                    dst = get_addr(host_alias(dst_host))
-                    if not dst:
-                        raise ValueError(f'Cannot resolve hostname {dst_host}')
-                    apply_config(iface, src, dst, config)
-
-                last_net_config = net_config
+            if push:
+                try:
+                    for version, net_config in subscribe(f'{url}/stream',
+                                                         keepalive):
+                        last_net_config = update_config(
+                            iface, src, net_config, last_net_config, tc,
+                            addresses)
+                        if pending(net_config, last_net_config):
+                            break  # poll until resolved
+                except requests.exceptions.RequestException as e:
+                    logger.warning(f'Stream failed, polling instead: {e}')
+
+            # request only changes since the version in use
+            if version:
+                r = requests.get(url, params={'since': version.strip('"')},
+                                 headers={'If-None-Match': version})
+            else:
+                r = requests.get(url)
+
+            if r.status_code != 304:
+                net_config = r.json()
+                if 'Delta-Base' in r.headers:
+                    net_config = merge_config(last_net_config, net_config)
+                last_net_config = update_config(iface, src, net_config,
+                                                last_net_config, tc,
+                                                addresses)
+
+            # request full configurations to retry unresolved hostnames
+            version = r.headers.get('ETag')
+            if pending(net_config, last_net_config):
+                version = None
 
         except requests.exceptions.InvalidURL:
             print(f'Error: invalid URL {url}')
             sys.exit(1)
         except requests.exceptions.ConnectionError:
-            print(f'Error: cannot connect to {server}:8888')
+            print(f'Error: cannot connect to {server}:{port}')
 
         time.sleep(period)
 
@@ -104,7 +578,18 @@ def polling(src_host, server, period):
 @click.argument('config', type=click.File('r'))
 @click.option('--host', default=platform.node(),
               help='Run as the given source host.')
-def run(config, host):
+@click.option('--port', type=int, default=8888,
+              help='Port of the VCE server.')
+@click.option('--push', is_flag=True,
+              help='Receive parameters pushed by the server.')
+@click.option('--tc-mode', type=click.Choice(['tcset', 'batch', 'hash']),
+              default=None,
+              help='Apply changes with tcset, with a single tc batch, or '
+                   'with a tc batch of hashed filters (default: tcset, or '
+                   'batch with declared links).')
+@click.option('--schedule', is_flag=True,
+              help='Download parameters of all time steps at startup.')
+def run(config, host, port, push, tc_mode, schedule):
     """Run the VCE agent.
 
     This command starts querying the VCE server for constellation
@@ -113,10 +598,26 @@ def run(config, host):
     config = parse(config)
 
     # server hostname
-    server = host_alias(config['system']['server']['hostname'])
+    server = config['system']['server']['hostname']
 
     # inteval betwen requests to the server
     period = config['system']['agent_interval']
 
+    # drop packets to undeclared links of sparse topologies
+    network = None
+    if get_links(config) is not None:
+        network = config['system']['ip_range']
+        if tc_mode == 'tcset':
+            raise click.UsageError('Declared links need --tc-mode batch '
+                                   'or hash')
+    tc_mode = tc_mode or ('batch' if network else 'tcset')
+
+    # resolve addresses of all nodes once
+    addresses = host_addresses(config)
+
+    # longest interval between messages of the server (one orbits step)
+    keepalive = config['system']['orbits']['step']*60
+
     # start the polling loop
-    polling(host, server, period)
+    polling(host, server, period, push, network, port, tc_mode, addresses,
+            schedule, keepalive)
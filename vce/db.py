@@ -1,4 +1,6 @@
 import logging
+import queue
+import threading
 import click
 from .utils import parse, db_client
 
@@ -33,6 +35,74 @@ def reset(config):
     logging.info(f'Created database {name}')
 
 
+def escape_tag(value):
+    """Escape a tag value for the InfluxDB line protocol."""
+    for char in '\\, =':
+        value = value.replace(char, f'\\{char}')
+    return value
+
+
+class BatchWriter:
+    """Writer of InfluxDB line-protocol records in batches of fixed
+    size, sent by the calling thread or by a background thread."""
+
+    def __init__(self, client, batch_size=5000, background=False):
+        self.client = client
+        self.batch_size = batch_size
+        self.batch = []
+        self.queue, self.thread, self.error = None, None, None
+        if background:
+            # bounded queue: at most two batches wait in memory
+            self.queue = queue.Queue(maxsize=2)
+            self.thread = threading.Thread(target=self.send_queued,
+                                           daemon=True)
+            self.thread.start()
+
+    def write(self, lines):
+        """Write an iterable of line-protocol records."""
+        for line in lines:
+            self.batch.append(line)
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Send the records written since the last batch."""
+        if self.error is not None:
+            raise self.error
+        if self.batch:
+            batch, self.batch = self.batch, []
+            if self.queue is None:
+                self.send(batch)
+            else:
+                self.queue.put(batch)
+
+    def send(self, batch):
+        """Send a batch of records to the database."""
+        self.client.write_points(batch, protocol='line')
+        logger.info(f'Wrote {len(batch)} points')
+
+    def send_queued(self):
+        """Send batches from the queue until closed (in a thread)."""
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is None:
+                try:
+                    self.send(batch)
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        """Send the remaining records and stop the background thread."""
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+
+
 def get_databases(client):
     """Get the names of all databases."""
     for db in client.get_list_database():
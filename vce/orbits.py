@@ -1,9 +1,18 @@
 from datetime import datetime, timedelta
+from itertools import chain
+import bisect
+import csv
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import logging
+import os
+import tempfile
 import click
-from skyfield.api import EarthSatellite, load, utc
-from .utils import parse, db_client
-from math import radians, sin, cos, sqrt
+from skyfield.api import EarthSatellite, load
+from .utils import parse, db_client, get_links
+from .db import BatchWriter, escape_tag
 import numpy as np
+from scipy.spatial import cKDTree
 import matplotlib
 matplotlib.use('pdf')
 import matplotlib.pyplot as plt
@@ -11,6 +20,9 @@ from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.animation import FuncAnimation
 
 
+logger = logging.getLogger(__name__)
+
+
 @click.group()
 def orbits():
     """Satellite orbit propagation and plotting"""
@@ -19,69 +31,344 @@ def orbits():
 
 @orbits.command()
 @click.argument('config', type=click.File('r'))
-def compute(config):
+@click.option('--delays', type=click.Path(), default=None,
+              help='Also save delays to a file (the server reads '
+                   '<db name>.delays.npy by default).')
+@click.option('--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of processes propagating orbits.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=5000,
+              help='Number of points per database write.')
+@click.option('--backend', type=click.Choice(['skyfield', 'sgp4']),
+              default='skyfield',
+              help='Propagate with skyfield or with the sgp4 array API.')
+@click.option('--write-thread', is_flag=True,
+              help='Write points to the database from a background thread.')
+@click.option('--ecef', is_flag=True,
+              help='Also save ECEF coordinates (x, y, z in km).')
+@click.option('--delay-series', is_flag=True,
+              help='Also save delays between hosts on the database '
+                   '(needs --delays).')
+def compute(config, delays, jobs, batch_size, backend, write_thread, ecef,
+            delay_series):
     """Compute and save satellite positions on the database.
 
     This command parses the YAML configuration in the CONFIG argument,
     computes satellite orbital positions, and stores them in the
     timeseries database. The position of base stations is also saved
     at a single time-point (the initial simulation time).
+
+    Satellites with positions already saved for the same TLE lines and
+    time grid are skipped (or propagated only for new time steps).
+
+    With --delays, line-of-sight delays between hosts at each time step
+    are also saved to a file (only between linked hosts, if links are
+    declared), and can be saved on the database (only when changed).
+    Delays already saved for the same hosts, orbits, and links are
+    computed only for time steps with new positions.
     """
+    if delay_series and not delays:
+        raise click.UsageError('Use --delay-series with --delays')
     config = parse(config)
     client = db_client(config)
+    writer = BatchWriter(client, batch_size, write_thread)
 
-    start_time = config['system']['orbits']['start'].replace(tzinfo=utc)
+    # prepare observation times (precompute MT and gast)
+    start, step, count = orbits_ticks(config)
+    times_ns, times_utc = time_grid(config, load.timescale())
+    times_utc.MT
+    times_utc.gast
 
     # save position of ground stations
-    points = []
     for station in config['stations']:
-        hostname = station['hostname']
-        lat = station['lat']
-        lon = station['lon']
-        alt = station['alt']
-        points.append({'measurement': 'pos',
-                       'time': start_time,
-                       'fields': {'lat': lat, 'lon': lon, 'alt': alt},
-                       'tags': {'host': hostname}})
-    client.write_points(points)
+        writer.write(pos_lines(station['hostname'], times_ns[:1],
+                               [station['lat']], [station['lon']],
+                               [station['alt']], ecef))
 
-    # prepare observation times (precompute MT and gast)
-    step = timedelta(minutes=config['system']['orbits']['step'])
-    duration = timedelta(minutes=config['system']['orbits']['duration'])
-    end_time = start_time + duration
-    times = []
-    t = start_time
-    while t <= end_time:
-        times.append(t)
-        t += step
+    # find the first time step to propagate for each satellite
+    satellites = config['satellites']
+    saved = load_orbit_hashes(client)
+    hashes, firsts = [], []
+    for satellite in satellites:
+        hostname = satellite['hostname']
+        digest = orbit_hash(satellite, times_ns[0], nanoseconds(step), ecef)
+        saved_hash, saved_end = saved.get(hostname, (None, None))
+        if saved_hash == digest:
+            first = int(np.searchsorted(times_ns, saved_end, side='right'))
+        else:
+            first = 0
+            if saved_hash is not None:
+                logger.info(f'Deleting outdated positions of {hostname}')
+                client.query(f"DELETE FROM pos WHERE host = "
+                             f"'{hostname}'")
+                client.query(f"DELETE FROM orbit WHERE host = "
+                             f"'{hostname}'")
+        hashes.append(digest)
+        firsts.append(first)
 
-    ts = load.timescale()
-    times_utc = ts.utc(times)
-    times_utc.MT
-    times_utc.gast
+    # first time step of the delays to compute (the delays of previous
+    # time steps are still valid if saved with the same inputs)
+    hosts = [node['hostname'] for node in
+             chain(satellites, config['stations'])]
+    first = count
+    if delays:
+        pairs = link_pairs(hosts, get_links(config))
+        digest = delays_hash(config, pairs)
+        first = min(firsts + [saved_delays(
+            delays, digest, delays_shape(count, len(hosts), pairs))])
+
+    # ECEF positions of all hosts (satellites, then stations) from the
+    # first time step, kept in a temporary file next to the delays file
+    positions = np.empty((0, len(hosts), 3))
+    if first < count:
+        scratch = tempfile.TemporaryFile(
+            dir=os.path.dirname(os.path.abspath(delays)))
+        positions = np.memmap(scratch, dtype=float, mode='w+',
+                              shape=(count - first, len(hosts), 3))
+        for k, station in enumerate(config['stations'], len(satellites)):
+            positions[:, k] = ecef_array(station['lat'], station['lon'],
+                                         station['alt'])
+
+        # load saved positions of satellites, one at a time
+        index = {hosts[k]: k for k in range(len(satellites))
+                 if firsts[k] > first}
+        for host, times, values in db_series(client, list(index)):
+            positions[:, index.pop(host)] = ecef_array(*grid_positions(
+                [(host, times, values)], [host], start + first*step, step,
+                count - first))[:, 0]
+        for k in index.values():
+            positions[:, k] = np.nan
+
+    # save position of satellites, as each one is propagated
+    todo = [k for k in range(len(satellites)) if firsts[k] < count]
+    logger.info(f'Propagating {len(todo)} of {len(satellites)} satellites')
+    tles = [(satellites[k]['tle1'], satellites[k]['tle2']) for k in todo]
+    computed = propagate_all(tles, times_utc, jobs,
+                             [firsts[k] for k in todo], backend)
+    for k, pos in zip(todo, computed):
+        writer.write(pos_lines(satellites[k]['hostname'],
+                               times_ns[firsts[k]:], *pos, ecef))
+        if first < count:
+            positions[firsts[k]-first:, k] = ecef_array(*pos)
+    for k in todo:
+        writer.write(orbit_lines(satellites[k]['hostname'], hashes[k],
+                                 times_ns[0], times_ns[-1]))
+    writer.close()
+
+    if not delays:
+        return
+
+    # save delays between linked hosts
+    logger.info(f'Computing delays of {count - first} of {count} '
+                f'time steps')
+    save_delays(delays, positions, pairs, first, digest)
+    del positions
+
+    # save delays from the first time step computed (or not yet saved)
+    if delay_series:
+        results = client.query('SELECT hash, "end" FROM delay_hash')
+        saved = [tuple(values[1:]) for series in
+                 results.raw.get('series', []) for values in series['values']]
+        if saved and saved[-1][0] == digest:
+            first = min(first, int(np.searchsorted(times_ns, saved[-1][1],
+                                                   side='right')))
+        else:
+            first = 0
+        since = times_ns[first] if first < count else times_ns[-1] + 1
+        client.query(f'DELETE FROM delay WHERE time >= {since}')
+        writer = BatchWriter(client, batch_size, write_thread)
+        writer.write(delay_lines(hosts, times_ns[first:],
+                                 np.load(delays, mmap_mode='r')[first:],
+                                 pairs))
+        writer.write([f'delay_hash hash="{digest}",end={times_ns[-1]}i '
+                      f'{times_ns[0]}'])
+        writer.close()
+
+
+def pos_lines(host, times, lat, lon, alt, ecef=False):
+    """Generate InfluxDB line-protocol records of host positions, given
+    times (in nanoseconds) and arrays of coordinates (with ECEF fields
+    x, y, z in km, if `ecef` is set)."""
+
+    tag = f'pos,host={escape_tag(host)}'
+    lat, lon, alt = (np.asarray(v, dtype=float) for v in (lat, lon, alt))
+    fields = ([f'lat={lat_t!r},lon={lon_t!r},alt={alt_t!r}'
+               for lat_t, lon_t, alt_t in zip(lat.tolist(), lon.tolist(),
+                                              alt.tolist())])
+    if ecef:
+        fields = [f'{f},x={x!r},y={y!r},z={z!r}' for f, (x, y, z) in
+                  zip(fields, ecef_array(lat, lon, alt).tolist())]
+    for t, f in zip(np.asarray(times).tolist(), fields):
+        yield f'{tag} {f} {t}'
+
+
+def delay_lines(hosts, times, delays, pairs=None):
+    """Generate InfluxDB line-protocol records of delays between hosts,
+    given times (in nanoseconds) and delays at each time (as saved by
+    `save_delays`, with the same linked `pairs`).
+
+    Each pair (i, j) with i < j (all pairs, or linked `pairs`) is tagged
+    with src and dst hostnames and written only when its delay changes,
+    as delay (in seconds) and loss 0, or loss 100 without line of sight.
+    """
+
+    i, j = np.triu_indices(len(hosts), 1) if pairs is None else pairs
+    tags = [f'delay,src={escape_tag(hosts[src])},dst={escape_tag(hosts[dst])}'
+            for src, dst in zip(i.tolist(), j.tolist())]
+
+    last = None
+    for t, matrix in zip(np.asarray(times).tolist(), delays):
+        values = np.asarray(matrix[i, j] if pairs is None else matrix,
+                            dtype=float)
+        changed = np.ones(len(values), dtype=bool) if last is None else \
+            (values != last) & ~(np.isnan(values) & np.isnan(last))
+        for k, delay in zip(np.flatnonzero(changed).tolist(),
+                            values[changed].tolist()):
+            if np.isnan(delay):
+                yield f'{tags[k]} loss=100i {t}'
+            else:
+                yield f'{tags[k]} delay={delay!r},loss=0i {t}'
+        last = values
+
+
+def orbit_hash(satellite, start, step, ecef=False):
+    """Get a content hash of the TLE lines of a satellite and of the
+    time grid (start and step, in nanoseconds) of its orbit, and of the
+    saved fields (with or without ECEF coordinates)."""
+
+    content = f"{satellite['tle1']}\n{satellite['tle2']}\n{start}\n{step}"
+    if ecef:
+        content += '\necef'
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def orbit_lines(host, digest, start, end):
+    """Generate InfluxDB line-protocol records of the content hash and
+    last time step (in nanoseconds) of a saved orbit."""
+
+    yield f'orbit,host={escape_tag(host)} hash="{digest}",end={end}i {start}'
+
+
+def load_orbit_hashes(client):
+    """Get the content hash and last time step (in nanoseconds) of the
+    orbits saved on the database, by hostname."""
+
+    results = client.query('SELECT hash, "end" FROM orbit GROUP BY host')
+    return {series['tags']['host']: tuple(series['values'][-1][1:])
+            for series in results.raw.get('series', [])}
+
+
+#: Observation times of orbit propagation workers
+shared_times = None
+
+
+def init_propagation(times):
+    """Set the observation times of orbit propagation."""
+    global shared_times
+    shared_times = times
+
+
+def propagate(tle, first=0):
+    """Compute latitude, longitude, and altitude of a satellite (given
+    by its TLE lines) at the observation times, from index `first`."""
+
+    times = shared_times if first == 0 else shared_times[first:]
+    pos = EarthSatellite(*tle).at(times).subpoint()
+    return pos.latitude.degrees, pos.longitude.degrees, pos.elevation.m
+
+
+def propagate_all(tles, times, jobs=1, firsts=None, backend='skyfield'):
+    """Generate positions of satellites at the given times (from the
+    index in `firsts` for each satellite), in order, sharding satellites
+    over a pool of `jobs` processes (or with the array API of the sgp4
+    library, if the backend is 'sgp4')."""
+
+    firsts = firsts or [0]*len(tles)
+    if backend == 'sgp4':
+        # batches of at most 1000 satellites per call to sgp4
+        size = max(1, min(1000, -(-len(tles) // jobs)))
+        function = propagate_batch
+        args = ([tles[k:k+size] for k in range(0, len(tles), size)],
+                [firsts[k:k+size] for k in range(0, len(tles), size)])
+    else:
+        function, args = propagate, (tles, firsts)
+
+    if jobs == 1:
+        init_propagation(times)
+        results = map(function, *args)
+        yield from (chain.from_iterable(results) if backend == 'sgp4'
+                    else results)
+    else:
+        chunksize = max(1, len(args[0]) // (4*jobs))
+        with ProcessPoolExecutor(jobs, initializer=init_propagation,
+                                 initargs=(times,)) as executor:
+            results = executor.map(function, *args, chunksize=chunksize)
+            yield from (chain.from_iterable(results) if backend == 'sgp4'
+                        else results)
+
+
+def propagate_batch(tles, firsts):
+    """Compute latitude, longitude, and altitude of a batch of satellites
+    at the observation times (from the index in `firsts` for each
+    satellite), with a single call to the array API of sgp4.
+
+    TEME positions are rotated to ECEF by the Greenwich mean sidereal
+    time (as skyfield does, without polar motion) and converted to
+    geodetic coordinates in vectorized form. Results match `propagate`
+    within 1e-6 degrees in latitude and longitude and 1 m in altitude
+    (skyfield uses the IERS 2010 ellipsoid instead of WGS84).
+    """
+    from sgp4.api import Satrec, SatrecArray
+
+    jd, fraction, theta = sgp4_times(shared_times)
+    satellites = SatrecArray([Satrec.twoline2rv(*tle) for tle in tles])
+    _, r, _ = satellites.sgp4(jd, fraction)  # NaN on errors
+
+    lat, lon, alt = geodetic_array(teme_to_ecef(r, theta))
+    return [(lat[k, first:], lon[k, first:], alt[k, first:])
+            for k, first in enumerate(firsts)]
+
+
+def propagate_at(satellites, index, times):
+    """Compute ECEF positions (in km) of sgp4 satellite records, one for
+    each element of the `index` array, at the corresponding skyfield
+    times (with one call to sgp4 per distinct satellite)."""
+
+    jd, fraction, theta = sgp4_times(times)
+    r = np.full((len(index), 3), np.nan)
+    for k in np.unique(index).tolist():
+        select = index == k
+        _, r[select], _ = satellites[k].sgp4_array(jd[select],
+                                                   fraction[select])
+    return teme_to_ecef(r, theta)
+
+
+def sgp4_times(times):
+    """Get the UTC julian dates (whole and fraction) taken by sgp4 and the
+    Greenwich mean sidereal time (in radians) of skyfield times."""
+    from skyfield.sgp4lib import theta_GMST1982
+
+    # sgp4 takes UTC julian dates, the sidereal time takes UT1
+    jd = np.broadcast_to(times.whole, times.shape)
+    fraction = times.ut1_fraction - times.dut1/86400
+    theta, _ = theta_GMST1982(times.whole, times.ut1_fraction)
+    return jd, fraction, theta
 
-    # save position of satellites
-    points = []
-    for satellite in config['satellites']:
-        hostname = satellite['hostname']
-        tle1 = satellite['tle1']
-        tle2 = satellite['tle2']
-        pos = EarthSatellite(tle1, tle2).at(times_utc).subpoint()
-        for t, lat, lon, alt in zip(times,
-                                    pos.latitude.degrees,
-                                    pos.longitude.degrees,
-                                    pos.elevation.m):
-            points.append({'measurement': 'pos',
-                           'time': t,
-                           'fields': {'lat': lat, 'lon': lon, 'alt': alt},
-                           'tags': {'host': hostname}})
-    client.write_points(points)
+
+def teme_to_ecef(r, theta):
+    """Rotate TEME positions (with x, y, z on the last axis) to ECEF by
+    the Greenwich mean sidereal time theta (about the z axis)."""
+
+    x, y, z = np.moveaxis(r, -1, 0)
+    ctheta, stheta = np.cos(theta), np.sin(theta)
+    return np.stack((ctheta*x + stheta*y, ctheta*y - stheta*x, z), axis=-1)
 
 
 @orbits.command()
 @click.argument('config', type=click.File('r'))
 @click.argument('pdf_name', type=click.Path())
-def plot2d(config, pdf_name):
+@click.option('--ephemeris', type=click.Path(exists=True), default=None,
+              help='Read positions from an exported ephemeris file.')
+def plot2d(config, pdf_name, ephemeris):
     """Plot satellite positions from the database.
 
     This command parses the YAML configuration in the CONFIG argument,
@@ -89,20 +376,13 @@ def plot2d(config, pdf_name):
     positions (and base station locations), and plots them on a map.
     """
     config = parse(config)
-    client = db_client(config)
 
-    # query data and transpose for matplotlib
-    results = client.query('SELECT lat, lon, alt FROM pos '
-                           'GROUP BY host ORDER BY time')
+    # load data and transpose for matplotlib
     data = []
-    for series in results.raw['series']:
-        time, lat, lon, alt = [], [], [], []
-        for t, lat_t, lon_t, alt_t in series['values']:
-            time.append(datetime.fromisoformat(t[:-1]))
-            lat.append(lat_t)
-            lon.append(lon_t)
-            alt.append(alt_t)
-        data.append([series['tags']['host'], time, lat, lon, alt])
+    for host, times, values in position_series(config, ephemeris):
+        time = [utc_datetime(t) for t in times.tolist()]
+        lat, lon, alt = values.T
+        data.append([host, time, lat, lon, alt])
 
     # plot on a map
     matplotlib.rcParams['font.sans-serif'] = ['Roboto', 'Arial']
@@ -151,21 +431,16 @@ def plot2d(config, pdf_name):
     t = [0]*len(data)
     tmax = [len(time) for _, time, _, _, _ in data]
     min_time = -1
+    moving = np.array([len(time) > 1 for _, time, _, _, _ in data])
+    xyz = [ecef_array(lat, lon, alt) for _, _, lat, lon, alt in data]
     while min_time is not None:
-        for i in range(len(data)):
-            for j in range(i):
-                if len(data[i][1]) > 1 or len(data[j][1]) > 1:
-                    p1 = np.array(ecef_xyz(data[i][2][t[i]],
-                                           data[i][3][t[i]],
-                                           data[i][4][t[i]]))
-                    p2 = np.array(ecef_xyz(data[j][2][t[j]],
-                                           data[j][3][t[j]],
-                                           data[j][4][t[j]]))
-                    latency = sight_latency(p1, p2)
-                    if latency is not None:
-                        plt.plot([data[i][3][t[i]], data[j][3][t[j]]],
-                                 [data[i][2][t[i]], data[j][2][t[j]]],
-                                 color='#FF00007F', linewidth=0.3)
+        pos = np.array([xyz[i][t[i]] for i in range(len(data))])
+        latency = sight_latencies(pos)
+        for i, j in zip(*np.nonzero(np.tril(~np.isnan(latency), -1) &
+                                    (moving[:, None] | moving))):
+            plt.plot([data[i][3][t[i]], data[j][3][t[j]]],
+                     [data[i][2][t[i]], data[j][2][t[j]]],
+                     color='#FF00007F', linewidth=0.3)
         # advance time to next value
         min_hosts, min_time = [], None
         for i in range(len(t)):
@@ -187,7 +462,9 @@ def plot2d(config, pdf_name):
 @click.argument('pdf_name', type=click.Path())
 @click.option('--interactive', is_flag=True,
               help='Open in an interactive QT5 window')
-def plot3d(config, pdf_name, interactive):
+@click.option('--ephemeris', type=click.Path(exists=True), default=None,
+              help='Read positions from an exported ephemeris file.')
+def plot3d(config, pdf_name, interactive, ephemeris):
     """Plot satellite positions from the database in 3D.
 
     This command parses the YAML configuration in the CONFIG argument,
@@ -195,21 +472,13 @@ def plot3d(config, pdf_name, interactive):
     positions (and base station locations), and plots them in 3D.
     """
     config = parse(config)
-    client = db_client(config)
 
-    # query data and transpose for matplotlib
-    results = client.query('SELECT lat, lon, alt FROM pos '
-                           'GROUP BY host ORDER BY time')
+    # load data and transpose for matplotlib
     data = []
-    for series in results.raw['series']:
-        time, x, y, z = [], [], [], []
-        for t, lat_t, lon_t, alt_t in series['values']:
-            time.append(datetime.fromisoformat(t[:-1]))
-            x_t, y_t, z_t = ecef_xyz(lat_t, lon_t, alt_t)
-            x.append(x_t)
-            y.append(y_t)
-            z.append(z_t)
-        data.append([series['tags']['host'], time, x, y, z])
+    for host, times, values in position_series(config, ephemeris):
+        time = [utc_datetime(t) for t in times.tolist()]
+        x, y, z = ecef_array(*values.T).T
+        data.append([host, time, x, y, z])
 
     # plot a reference ellipsoid
     matplotlib.use('Qt5Agg')
@@ -247,18 +516,17 @@ def plot3d(config, pdf_name, interactive):
     t = [0]*len(data)
     tmax = [len(time) for _, time, _, _, _ in data]
     min_time = -1
+    moving = np.array([len(time) > 1 for _, time, _, _, _ in data])
     while min_time is not None:
-        for i in range(len(data)):
-            for j in range(i):
-                if len(data[i][1]) > 1 or len(data[j][1]) > 1:
-                    p1 = [data[i][d][t[i]] for d in range(2, 5)]
-                    p2 = [data[j][d][t[j]] for d in range(2, 5)]
-                    latency = sight_latency(p1, p2)
-                    if latency is not None:
-                        ax.plot([data[i][2][t[i]], data[j][2][t[j]]],
-                                [data[i][3][t[i]], data[j][3][t[j]]],
-                                [data[i][4][t[i]], data[j][4][t[j]]],
-                                color='#FF00006F', linewidth=1.0)
+        pos = np.array([[data[i][d][t[i]] for d in range(2, 5)]
+                        for i in range(len(data))])
+        latency = sight_latencies(pos)
+        for i, j in zip(*np.nonzero(np.tril(~np.isnan(latency), -1) &
+                                    (moving[:, None] | moving))):
+            ax.plot([data[i][2][t[i]], data[j][2][t[j]]],
+                    [data[i][3][t[i]], data[j][3][t[j]]],
+                    [data[i][4][t[i]], data[j][4][t[j]]],
+                    color='#FF00006F', linewidth=1.0)
         # advance time to next value
         min_hosts, min_time = [], None
         for i in range(len(t)):
@@ -282,19 +550,47 @@ wgs84_f = 1-wgs84_b/wgs84_a                   # flattening
 wgs84_ecc2 = wgs84_f*(2-wgs84_f)              # squared eccentricity
 
 
-def ecef_xyz(lat, lon, alt):
+def ecef_array(lat, lon, alt):
+    """Convert arrays of geodetic coordinates to ECEF positions.
+
+    Latitude and longitude are in degrees, altitude in meters; the
+    result has an additional last axis with x, y, z coordinates in km.
+    """
     # see: agamenon.tsc.uah.es/Asignaturas/it/rd/apuntes/RxControl_Manual.pdf
     # checked against: https://www.ngs.noaa.gov/NCAT/
-    # lat, lon in degrees, alt in meters
-    alt = alt/1000  # all calculations in km
-    phi, lam = radians(lat), radians(lon)
-    sphi, cphi = sin(phi), cos(phi)
-    slam, clam = sin(lam), cos(lam)
-    r = wgs84_a/sqrt(1-wgs84_ecc2*sphi*sphi)
+    alt = np.asarray(alt, dtype=float)/1000  # all calculations in km
+    phi, lam = np.radians(lat), np.radians(lon)
+    sphi, cphi = np.sin(phi), np.cos(phi)
+    slam, clam = np.sin(lam), np.cos(lam)
+    r = wgs84_a/np.sqrt(1-wgs84_ecc2*sphi*sphi)
     x = (alt+r)*cphi*clam
     y = (alt+r)*cphi*slam
     z = (alt+r*(1-wgs84_ecc2))*sphi
-    return x, y, z
+    return np.stack((x, y, z), axis=-1)
+
+
+def ecef_xyz(lat, lon, alt):
+    # lat, lon in degrees, alt in meters
+    return tuple(ecef_array(lat, lon, alt).tolist())
+
+
+def geodetic_array(pos, iterations=4):
+    """Convert ECEF positions (in km, with x, y, z on the last axis) to
+    arrays of latitude and longitude (in degrees) and altitude (in
+    meters), inverting `ecef_array` by fixed-point iteration."""
+
+    x, y, z = np.moveaxis(np.asarray(pos, dtype=float), -1, 0)
+    p = np.hypot(x, y)
+    phi = np.arctan2(z, p*(1-wgs84_ecc2))
+    for _ in range(iterations):
+        sphi = np.sin(phi)
+        r = wgs84_a/np.sqrt(1-wgs84_ecc2*sphi*sphi)
+        phi = np.arctan2(z + wgs84_ecc2*r*sphi, p)
+
+    sphi, cphi = np.sin(phi), np.cos(phi)
+    r = wgs84_a/np.sqrt(1-wgs84_ecc2*sphi*sphi)
+    alt = p*cphi + z*sphi - r*(1-wgs84_ecc2*sphi*sphi)
+    return (np.degrees(phi), np.degrees(np.arctan2(y, x)), alt*1000)
 
 
 def earth_ellipsoid(ax):
@@ -341,30 +637,238 @@ def earth_ellipsoid(ax):
 
 axes = np.array([wgs84_a, wgs84_a, wgs84_b])
 speed = 299792458.0
+sight_tolerance = 1e-9  # margin of positions on the ellipsoid (rounding)
 
 
-def sight_latency(p1, p2):
-    p1, p2 = np.array(p1), np.array(p2)
-    dist = np.linalg.norm(p1-p2)
-    if dist < 5:  # distance less than 5 km, no latency
-        return 0.0
-    s1, s2 = p1/axes, p2/axes
+def pair_latencies(p1, p2):
+    """Get line-of-sight latencies between pairs of ECEF positions.
+
+    Positions are arrays of shape (..., 3) in km, broadcast against each
+    other; latencies are in seconds, NaN when the segment between the
+    two positions intersects the WGS84 ellipsoid (with the tolerance of
+    `sight_margins` for positions on the ellipsoid, in both directions).
+    """
+    p1, p2 = np.asarray(p1, dtype=float), np.asarray(p2, dtype=float)
+    dist = np.linalg.norm(p1-p2, axis=-1)
+    sight = sight_margins(p1, p2) >= -sight_tolerance
+    latency = np.where(sight, dist/speed*1000, np.nan)
+    # distance less than 5 km, no latency
+    return np.where(dist < 5, 0.0, latency)
+
+
+def sight_margins(p1, p2):
+    """Get line-of-sight margins between pairs of ECEF positions.
+
+    The margin is the minimum of |s|^2 - 1 over the segment between the
+    two positions, with coordinates s scaled by the WGS84 axes: it is
+    continuous in the positions and negative when the segment
+    intersects the ellipsoid (no line of sight). Positions on the
+    ellipsoid (e.g., stations at altitude 0) have a margin of zero up
+    to rounding, so margins are compared with `-sight_tolerance`.
+    """
+    s1 = np.asarray(p1, dtype=float)/axes
+    s2 = np.asarray(p2, dtype=float)/axes
     s12 = s1-s2
-    a = np.dot(s12, s12)
-    b = np.sum(np.dot(s12, s2))*2
-    c = np.dot(s2, s2)-1
-    d = b**2 - 4*a*c
-    if d < 0.0:
-        return dist/speed*1000  # no intersection
+    a = np.sum(s12*s12, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = np.clip(np.nan_to_num(-np.sum(s12*s2, axis=-1)/a), 0.0, 1.0)
+    closest = s2 + u[..., None]*s12
+    return np.sum(closest*closest, axis=-1)-1
+
+
+def sight_ranges(pos):
+    """Get the maximum line-of-sight range (in km) from ECEF positions
+    in an array of shape (..., 3) to the horizon.
+
+    The range is the tangent distance to a sphere with the WGS84
+    semi-minor axis, which lies inside the ellipsoid: two positions
+    cannot see each other if their distance exceeds the sum of their
+    ranges.
+    """
+    radius2 = np.sum(np.square(pos), axis=-1)
+    return np.sqrt(np.maximum(radius2 - wgs84_b**2, 0.0))
+
+
+def sight_candidates(pos, pairs=None):
+    """Get index arrays (i, j) with i < j of ECEF positions in an array
+    of shape (N, 3) that may be in line of sight (among given pairs, or
+    among all pairs using a k-d tree), discarding pairs farther than
+    the sum of their ranges to the horizon."""
+
+    pos = np.asarray(pos, dtype=float)
+    ranges = sight_ranges(pos)
+    if pairs is None:
+        valid = np.flatnonzero(~np.isnan(ranges))
+        limit = 2*np.median(ranges[valid]) if len(valid) else 0.0
+        large = np.zeros(len(pos), dtype=bool)
+        large[valid] = ranges[valid] > limit
+
+        # pairs of positions with small ranges, from a k-d tree
+        small = valid[~large[valid]]
+        radius = 2*ranges[small].max() + 5 if len(small) else 0.0
+        near = cKDTree(pos[small]).query_pairs(radius, output_type='ndarray')
+        i, j = [small[near[:, 0]]], [small[near[:, 1]]]
+
+        # pairs of positions with large ranges (e.g., GEO) with all others
+        for k in np.flatnonzero(large):
+            others = valid[~large[valid] | (valid > k)]
+            i.append(np.full(len(others), k))
+            j.append(others)
+        i, j = np.concatenate(i), np.concatenate(j)
     else:
-        q = (-b-np.sign(b)*np.sqrt(d))/2
-        sol1 = q/a
-        sol2 = c/q
-        if (sol1 < 0.0 or sol1 > 1.0) and \
-           (sol2 < 0.0 or sol2 > 1.0):
-            return dist/speed*1000  # outside of segment
-        else:
-            return None  # no line of sight
+        i, j = pairs
+
+    # keep pairs within the sum of their ranges (or less than 5 km)
+    dist = np.linalg.norm(pos[i] - pos[j], axis=-1)
+    near = (dist <= ranges[i] + ranges[j]) | (dist < 5)
+    return np.minimum(i, j)[near], np.maximum(i, j)[near]
+
+
+def sight_latencies(pos, pairs=None):
+    """Get the matrix of line-of-sight latencies between all pairs of
+    ECEF positions in an array of shape (N, 3).
+
+    Entry (i, j) is the latency in seconds from i to j, or NaN if there
+    is no line of sight. If index arrays (i, j) of linked pairs are
+    given, only those are evaluated (other pairs are NaN). Pairs out of
+    range are discarded before testing the intersection with the Earth.
+    """
+    pos = np.asarray(pos, dtype=float)
+    latency = np.full((len(pos), len(pos)), np.nan)
+    np.fill_diagonal(latency, 0.0)
+    if pairs is None:
+        i, j = sight_candidates(pos)
+        latency[i, j] = latency[j, i] = pair_latencies(pos[i], pos[j])
+    else:
+        i, j = pairs
+        latency[i, j] = latency[j, i] = link_latencies(pos, pairs)
+    return latency
+
+
+def link_latencies(pos, pairs):
+    """Get the line-of-sight latencies of linked pairs, given as index
+    arrays (i, j), of ECEF positions in an array of shape (N, 3).
+
+    Returns an array with the latency in seconds of each pair (NaN if
+    there is no line of sight).
+    """
+    pos = np.asarray(pos, dtype=float)
+    i, j = pairs
+    return pair_latencies(pos[i], pos[j])
+
+
+def link_pairs(hosts, links):
+    """Get index arrays (i, j) with i < j of linked hosts, or None if
+    all hosts are linked."""
+
+    if links is None:
+        return None
+
+    index = {host: i for i, host in enumerate(hosts)}
+    pairs = sorted({tuple(sorted((index[src], index[dst])))
+                    for src in links for dst in links[src]})
+    return tuple(np.array(pairs, dtype=int).reshape(-1, 2).T)
+
+
+def contact_windows(positions, pairs=None):
+    """Find the time steps when pairs of hosts are in line of sight.
+
+    Positions are ECEF coordinates with shape (T, N, 3). Returns arrays
+    (i, j, first, last) of host indices (i < j, among all pairs or the
+    given pairs) and of the first and last time step of each window.
+    """
+
+    count, n, _ = positions.shape
+    opened, windows = {}, []
+    previous = np.empty(0, dtype=np.int64)
+    for tick, pos in enumerate(positions):
+        i, j = sight_candidates(pos, pairs)
+        sight = sight_margins(pos[i], pos[j]) >= -sight_tolerance
+        codes = np.unique(i[sight]*n + j[sight])
+        for code in np.setdiff1d(codes, previous).tolist():
+            opened[code] = tick
+        for code in np.setdiff1d(previous, codes).tolist():
+            windows.append((code, opened.pop(code), tick - 1))
+        previous = codes
+    windows.extend((code, first, count - 1) for code, first in opened.items())
+
+    code, first, last = np.array(windows, dtype=np.int64).reshape(-1, 3).T
+    return code // n, code % n, first, last
+
+
+def bisect_crossings(sight, lo, hi, rising, resolution):
+    """Find line-of-sight changes between times lo and hi (arrays of
+    nanoseconds) by bisection, until within `resolution` nanoseconds.
+
+    The function `sight` gets an array of times and returns whether each
+    pair is in line of sight; pairs are in line of sight at hi (and not
+    at lo) where `rising` is set, and vice versa. Returns the last time
+    before and the first time after each change.
+    """
+
+    lo, hi = np.array(lo, dtype=np.int64), np.array(hi, dtype=np.int64)
+    while np.any(hi - lo > resolution):
+        mid = lo + (hi - lo)//2
+        changed = sight(mid) == rising
+        hi, lo = np.where(changed, mid, hi), np.where(changed, lo, mid)
+    return lo, hi
+
+
+def save_contacts(output, hosts, i, j, start, end):
+    """Write contact windows between hosts i and j (from start to end,
+    in nanoseconds) as CSV rows sorted by start time."""
+
+    writer = csv.writer(output)
+    writer.writerow(['src', 'dst', 'start', 'end', 'duration'])
+    for k in np.lexsort((j, i, start)).tolist():
+        writer.writerow([hosts[i[k]], hosts[j[k]],
+                         utc_datetime(int(start[k])).isoformat(),
+                         utc_datetime(int(end[k])).isoformat(),
+                         f'{(end[k] - start[k])/1e9:.6f}'])
+
+
+def load_contacts(path, hosts):
+    """Load contact windows saved by `vce orbits contacts`, as a dict of
+    (sorted start times, end times) in nanoseconds by pair (i, j) of
+    host indices, with i < j. Windows of unknown hosts are ignored."""
+
+    index = {host: i for i, host in enumerate(hosts)}
+    contacts = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            if row['src'] not in index or row['dst'] not in index:
+                continue
+            i, j = sorted((index[row['src']], index[row['dst']]))
+            contacts.setdefault((i, j), []).append(
+                (nanoseconds(datetime.fromisoformat(row['start'])),
+                 nanoseconds(datetime.fromisoformat(row['end']))))
+    return {pair: tuple(map(list, zip(*sorted(windows))))
+            for pair, windows in contacts.items()}
+
+
+def in_contact(contacts, i, j, t):
+    """Check whether hosts i and j are in a contact window at time t (in
+    nanoseconds), by bisection over the start times of their windows."""
+
+    starts, ends = contacts.get((min(i, j), max(i, j)), ([], []))
+    k = bisect.bisect_right(starts, t) - 1
+    return k >= 0 and t <= ends[k]
+
+
+def contact_latencies(contacts, pos, i, dst, t):
+    """Get latencies (in seconds) from the i-th ECEF position to the
+    positions of destinations `dst`, NaN when not in a contact window at
+    time t (in nanoseconds)."""
+
+    dist = np.linalg.norm(pos[dst] - pos[i], axis=-1)
+    latency = np.where(dist < 5, 0.0, dist/speed*1000)
+    reachable = [in_contact(contacts, i, j, t) for j in np.asarray(dst)]
+    return np.where(reachable, latency, np.nan)
+
+
+def sight_latency(p1, p2):
+    latency = pair_latencies(p1, p2)
+    return None if np.isnan(latency) else float(latency)
 
 
 @orbits.command()
@@ -372,7 +876,9 @@ def sight_latency(p1, p2):
 @click.argument('gif_name', type=click.Path())
 @click.option('--interactive', is_flag=True,
               help='Open in an interactive QT5 window')
-def animate(config, gif_name, interactive):
+@click.option('--ephemeris', type=click.Path(exists=True), default=None,
+              help='Read positions from an exported ephemeris file.')
+def animate(config, gif_name, interactive, ephemeris):
     """Animate satellite positions from the database in 3D.
 
     This command parses the YAML configuration in the CONFIG argument,
@@ -380,19 +886,14 @@ def animate(config, gif_name, interactive):
     positions (and base station locations), and animates them.
     """
     config = parse(config)
-    client = db_client(config)
+    if ephemeris:
+        eph_times, eph_hosts, *eph_values = load_ephemeris(ephemeris)
+    else:
+        client = db_client(config)
     sats = set((sat['hostname'] for sat in config['satellites']))
 
     # prepare list of simulation times
-    start_time = config['system']['orbits']['start']
-    step = timedelta(minutes=config['system']['orbits']['step'])
-    duration = timedelta(minutes=config['system']['orbits']['duration'])
-    end_time = start_time + duration
-    times = []
-    t = start_time
-    while t <= end_time:
-        times.append(t)
-        t += step
+    times_ns, _ = time_grid(config)
 
     # plot a reference ellipsoid
     matplotlib.use('Qt5Agg')
@@ -406,7 +907,8 @@ def animate(config, gif_name, interactive):
     earth_ellipsoid(ax)
     title = plt.gcf().text(0.05, 0.05, '', color='#0000006F')
 
-    def update(time):
+    def update(time_ns):
+        time = utc_datetime(time_ns)
         for c in ax.get_children():
             if c.get_gid() == 'frame':
                 c.remove()
@@ -414,38 +916,44 @@ def animate(config, gif_name, interactive):
 
         time_str = time.isoformat()
         title.set_text(time_str)
-        results = client.query("SELECT lat, lon, alt FROM pos "
-                               f"WHERE time <= '{time_str}Z' GROUP BY host "
-                               "ORDER BY time DESC LIMIT 1")
+        if ephemeris:
+            # last row at or before the frame time, for known hosts
+            row = max(np.searchsorted(eph_times, time_ns, side='right')-1, 0)
+            lat, lon, alt = (values[row] for values in eph_values)
+            known = ~np.isnan(lat)
+            hosts = [host for host, k in zip(eph_hosts, known) if k]
+            lat, lon, alt = lat[known], lon[known], alt[known]
+        else:
+            results = client.query("SELECT lat, lon, alt FROM pos "
+                                   f"WHERE time <= '{time_str}Z' "
+                                   "GROUP BY host ORDER BY time DESC LIMIT 1")
+            series = results.raw['series']
+            hosts = [s['tags']['host'] for s in series]
+            lat, lon, alt = np.array([s['values'][0][1:]
+                                      for s in series]).T
+        pos = ecef_array(lat, lon, alt)
         data = []
-        for series in results.raw['series']:
-            host = series['tags']['host']
-            time, lat, lon, alt = series['values'][0]
-            time = datetime.fromisoformat(time[:-1])
-            x, y, z = ecef_xyz(lat, lon, alt)
+        for host, (x, y, z) in zip(hosts, pos):
             points = ax.scatter(x, y, z, gid='frame')
             color = points.get_facecolor()[0][0:3]
             ax.text(x+6, y+6, z+6, host, gid='frame',
                     fontsize=15, color=color)
-            data.append([host, time, x, y, z])
-
-        for i in range(len(data)):
-            for j in range(i):
-                if data[i][0] in sats or data[j][0] in sats:
-                    p1 = np.array([data[i][d] for d in range(2, 5)])
-                    p2 = np.array([data[j][d] for d in range(2, 5)])
-                    latency = sight_latency(p1, p2)
-                    if latency is not None:
-                        ax.plot([data[i][2], data[j][2]],
-                                [data[i][3], data[j][3]],
-                                [data[i][4], data[j][4]],
-                                color='#FF00006F',
-                                linewidth=1.0, gid='frame')
-                        halfway = (p1+p2)/2 + 6
-                        ax.text(*halfway, f'{latency*1000:.1f}',
-                                fontsize=10, color='#FF00006F', gid='frame')
-
-    animation = FuncAnimation(plt.gcf(), update, times,
+            data.append([host, x, y, z])
+
+        latency = sight_latencies(pos)
+        is_sat = np.array([host in sats for host, _, _, _ in data])
+        for i, j in zip(*np.nonzero(np.tril(~np.isnan(latency), -1) &
+                                    (is_sat[:, None] | is_sat))):
+            ax.plot([data[i][1], data[j][1]],
+                    [data[i][2], data[j][2]],
+                    [data[i][3], data[j][3]],
+                    color='#FF00006F',
+                    linewidth=1.0, gid='frame')
+            halfway = (pos[i]+pos[j])/2 + 6
+            ax.text(*halfway, f'{latency[i, j]*1000:.1f}',
+                    fontsize=10, color='#FF00006F', gid='frame')
+
+    animation = FuncAnimation(plt.gcf(), update, times_ns.tolist(),
                               interval=1000, blit=False, repeat=False)
 
     if interactive:
@@ -454,23 +962,435 @@ def animate(config, gif_name, interactive):
         animation.save(gif_name, writer='imagemagick')
 
 
-def get_delays(client, t, src):
-    """Get delays from a given source and time to all destinations."""
+@orbits.command()
+@click.argument('config', type=click.File('r'))
+@click.argument('path', type=click.Path(), required=False)
+def export(config, path):
+    """Export satellite positions from the database to a file.
 
-    # last timepoint before t
-    results = client.query(f'SELECT lat, lon, alt FROM pos '
-                           f"WHERE time <= '{t.isoformat()}Z' "
-                           f'GROUP BY host ORDER BY time DESC LIMIT 1')
+    This command parses the YAML configuration in the CONFIG argument
+    and saves the positions of all hosts at each orbits time step to
+    the PATH file (default: <db name>.ephemeris.npz). The file can be
+    read by plot commands and by the VCE server with --ephemeris, or
+    loaded back with `vce orbits import`.
+    """
+    config = parse(config)
+    hosts = [node['hostname'] for node in
+             chain(config['satellites'], config['stations'])]
+    times_ns, _ = time_grid(config)
+    lat, lon, alt = load_positions(db_client(config), hosts,
+                                   *orbits_ticks(config))
+    save_ephemeris(path or ephemeris_file(config), times_ns, hosts,
+                   lat, lon, alt)
+
+
+@orbits.command('import')
+@click.argument('config', type=click.File('r'))
+@click.argument('path', type=click.Path(exists=True), required=False)
+@click.option('--batch-size', type=click.IntRange(min=1), default=5000,
+              help='Positions written to the database per request.')
+def import_(config, path, batch_size):
+    """Import satellite positions from a file to the database.
+
+    This command parses the YAML configuration in the CONFIG argument
+    and replaces the positions of the hosts in the PATH file (default:
+    <db name>.ephemeris.npz) on the database. Imported orbits are
+    recomputed by the next `vce orbits compute`, and the delays file
+    (now stale) is removed.
+    """
+    config = parse(config)
+    client = db_client(config)
+    writer = BatchWriter(client, batch_size)
 
-    pos = {}
-    for series in results.raw['series']:
-        assert len(series['values']) == 1
-        host = series['tags']['host']
-        time, lat, lon, alt = series['values'][0]
-        pos[host] = np.array(ecef_xyz(lat, lon, alt))
+    for host, times, values in ephemeris_series(
+            path or ephemeris_file(config)):
+        client.query(f"DELETE FROM pos WHERE host = '{host}'")
+        client.query(f"DELETE FROM orbit WHERE host = '{host}'")
+        writer.write(pos_lines(host, times, *values.T))
+    writer.close()
+
+    try:
+        os.remove(delays_file(config))
+        logger.info(f'Removed stale delays file {delays_file(config)}')
+    except FileNotFoundError:
+        pass
+
+
+@orbits.command()
+@click.argument('config', type=click.File('r'))
+@click.argument('output', type=click.File('w'), default='-')
+@click.option('--jobs', type=click.IntRange(min=1), default=1,
+              help='Number of processes propagating orbits.')
+@click.option('--backend', type=click.Choice(['skyfield', 'sgp4']),
+              default='skyfield',
+              help='Propagate with skyfield or with the sgp4 array API.')
+@click.option('--resolution', type=click.FloatRange(min=0.001), default=1.0,
+              help='Resolution of start and end times (in ms).')
+def contacts(config, output, jobs, backend, resolution):
+    """Compute line-of-sight contact windows between hosts.
+
+    This command parses the YAML configuration in the CONFIG argument,
+    propagates satellite orbits at each orbits step, and finds the
+    steps when each pair of hosts (or of linked hosts) is in line of
+    sight. The start and end of each window are then refined by
+    bisection, propagating orbits at intermediate times. Windows are
+    written to OUTPUT (default: standard output) in CSV format, with
+    UTC start and end times. Windows shorter than an orbits step and
+    falling between two steps are not detected.
+    """
+    from sgp4.api import Satrec
+
+    config = parse(config)
+    ts = load.timescale()
+    times_ns, times_utc = time_grid(config, ts)
+    satellites, stations = config['satellites'], config['stations']
+    hosts = [node['hostname'] for node in chain(satellites, stations)]
+
+    # positions of all hosts at each orbits step
+    tles = [(satellite['tle1'], satellite['tle2'])
+            for satellite in satellites]
+    geodetic = np.empty((3, len(times_ns), len(hosts)))
+    for k, pos in enumerate(propagate_all(tles, times_utc, jobs,
+                                          backend=backend)):
+        geodetic[:, :, k] = pos
+    for k, station in enumerate(stations, len(satellites)):
+        geodetic[:, :, k] = [[station['lat']], [station['lon']],
+                             [station['alt']]]
+    positions = ecef_array(*geodetic)
+    i, j, first, last = contact_windows(
+        positions, link_pairs(hosts, get_links(config)))
+    logger.info(f'Found {len(i)} contact windows')
+
+    # positions of hosts at any time (stations are fixed)
+    records = [Satrec.twoline2rv(*tle) for tle in tles]
+
+    def host_positions(index, times):
+        pos = positions[0, index]
+        moving = index < len(records)
+        pos[moving] = propagate_at(records, index[moving],
+                                   skyfield_times(ts, times[moving]))
+        return pos
+
+    # refine windows starting or ending between orbits steps
+    resolution = int(resolution*1e6)
+    start, end = times_ns[first], times_ns[last]
+    for rising, step, times in ((True, first, start), (False, last, end)):
+        refine = (step > 0) if rising else (step < len(times_ns) - 1)
+        a, b = i[refine], j[refine]
+        lo = times_ns[step[refine] - 1] if rising else times_ns[step[refine]]
+        hi = times_ns[step[refine]] if rising else times_ns[step[refine] + 1]
+
+        def sight(t):
+            return sight_margins(host_positions(a, t),
+                                 host_positions(b, t)) >= -sight_tolerance
+
+        lo, hi = bisect_crossings(sight, lo, hi, rising, resolution)
+        times[refine] = hi if rising else lo
+
+    save_contacts(output, hosts, i, j, start, end)
+
+
+def orbits_ticks(config):
+    """Get start time, step, and number of time steps of the orbits."""
+
+    orbits = config['system']['orbits']
+    step = timedelta(minutes=orbits['step'])
+    duration = timedelta(minutes=orbits['duration'])
+    return orbits['start'], step, duration // step + 1
+
+
+def nanoseconds(t):
+    """Convert a UTC datetime (since the epoch) or a timedelta to an
+    integer number of nanoseconds."""
+
+    if isinstance(t, datetime):
+        t = t.replace(tzinfo=None) - datetime(1970, 1, 1)
+    return t // timedelta(microseconds=1) * 1000
+
+
+def time_grid(config, ts=None):
+    """Get the observation times of the orbits as an int64 array of
+    nanoseconds since the epoch and, if a skyfield timescale is given,
+    as skyfield times (from the UTC time of each step, without
+    building datetime objects)."""
+
+    start, step, count = orbits_ticks(config)
+    offsets = np.arange(count, dtype=np.int64)
+    times_ns = nanoseconds(start) + offsets*nanoseconds(step)
+    if ts is None:
+        return times_ns, None
+    return times_ns, skyfield_times(ts, times_ns)
+
+
+def skyfield_times(ts, times):
+    """Get skyfield times from an array of nanoseconds since the epoch."""
+
+    day = 86400*10**9
+    times = np.asarray(times, dtype=np.int64)
+    return ts.utc(1970, 1, 1 + times//day, 0, 0, (times % day)/1e9)
+
+
+def utc_datetime(t):
+    """Get a naive UTC datetime from nanoseconds since the epoch."""
+
+    return datetime(1970, 1, 1) + timedelta(microseconds=t//1000)
+
+
+def forward_fill(values):
+    """Replace NaN entries with the last valid entry along axis 0."""
+
+    index = np.where(np.isnan(values), 0,
+                     np.arange(len(values)).reshape((-1,) +
+                                                    (1,)*(values.ndim-1)))
+    np.maximum.accumulate(index, axis=0, out=index)
+    return np.take_along_axis(values, index, axis=0)
+
+
+def load_positions(client, hosts, start, step, count):
+    """Load the positions of the given hosts from the database.
+
+    Returns arrays of latitude, longitude, and altitude with shape
+    (count, len(hosts)): row k holds the last position saved at or
+    before time start + k*step (NaN if no position is available).
+    """
+
+    return grid_positions(db_series(client), hosts, start, step, count)
+
+
+def db_series(client, hosts=None):
+    """Generate the hostname, times (in nanoseconds), and positions
+    (latitude, longitude, altitude rows) of each host in the database
+    (or of the given hosts, with a query for each host)."""
+
+    if hosts is None:
+        queries = ['SELECT lat, lon, alt FROM pos GROUP BY host '
+                   'ORDER BY time']
+    else:
+        queries = [f"SELECT lat, lon, alt FROM pos WHERE host = '{host}' "
+                   f"GROUP BY host ORDER BY time" for host in hosts]
+
+    for query in queries:
+        results = client.query(query, epoch='ns')
+        for series in results.raw.get('series', []):
+            times = np.array([v[0] for v in series['values']],
+                             dtype=np.int64)
+            values = np.array([v[1:] for v in series['values']],
+                              dtype=float)
+            yield series['tags']['host'], times, values
+
+
+def position_series(config, ephemeris=None):
+    """Generate the positions of each host from an ephemeris file, if
+    given, or from the database of a configuration."""
+
+    if ephemeris:
+        return ephemeris_series(ephemeris)
+    return db_series(db_client(config))
+
+
+def grid_positions(series, hosts, start, step, count):
+    """Sample the positions of the given hosts at each time step, from
+    (hostname, times, positions) series such as those of `db_series`.
+
+    Returns arrays of latitude, longitude, and altitude with shape
+    (count, len(hosts)), as `load_positions`.
+    """
+
+    start_ns, step_ns = nanoseconds(start), nanoseconds(step)
+
+    index = {host: i for i, host in enumerate(hosts)}
+    pos = np.full((3, count, len(hosts)), np.nan)
+
+    for host, times, values in series:
+        if host not in index or not len(times):
+            continue
+
+        # keep the last timepoint at or before each time step (the
+        # first time step at or after each timepoint)
+        ticks = np.maximum(-((start_ns - times) // step_ns), 0)
+        ticks, last = np.unique(ticks[::-1], return_index=True)
+        last = len(times) - 1 - last
+        keep = ticks < count
+        pos[:, ticks[keep], index[host]] = values[last[keep]].T
+
+    lat, lon, alt = forward_fill(pos.transpose(1, 0, 2)).transpose(1, 0, 2)
+    return lat, lon, alt
+
+
+def interpolate_positions(positions, t):
+    """Interpolate ECEF positions with shape (T, N, 3) at a fractional
+    time step t, using cubic Hermite splines with velocities estimated
+    by finite differences (Catmull-Rom)."""
+
+    count = len(positions)
+    if count == 1:
+        return positions[0]
+
+    k = min(int(t), count - 2)
+    u = t - k
+    prev, after = max(k - 1, 0), min(k + 2, count - 1)
+    m0 = (positions[k+1] - positions[prev]) / (k + 1 - prev)
+    m1 = (positions[after] - positions[k]) / (after - k)
+
+    h00, h10 = 2*u**3 - 3*u**2 + 1, u**3 - 2*u**2 + u
+    h01, h11 = -2*u**3 + 3*u**2, u**3 - u**2
+    return h00*positions[k] + h10*m0 + h01*positions[k+1] + h11*m1
+
+
+def ephemeris_file(config):
+    """Get the default name of the ephemeris file of a configuration."""
+
+    return f"{config['system']['db']['name']}.ephemeris.npz"
+
+
+def save_ephemeris(path, times, hosts, lat, lon, alt):
+    """Save the positions of hosts at the given times (in nanoseconds).
+
+    The file is a compressed NumPy archive with arrays `times`, `hosts`,
+    and `lat`, `lon`, `alt` with shape (len(times), len(hosts)), NaN
+    where the position of a host is unknown.
+    """
+
+    np.savez_compressed(path, times=np.asarray(times, dtype=np.int64),
+                        hosts=np.array(hosts, dtype=str),
+                        lat=lat, lon=lon, alt=alt)
+
+
+def load_ephemeris(path):
+    """Load times, hosts, and latitude, longitude, altitude arrays from
+    a file saved by `save_ephemeris`."""
+
+    with np.load(path) as data:
+        return (data['times'], data['hosts'].tolist(),
+                data['lat'], data['lon'], data['alt'])
+
+
+def ephemeris_series(path):
+    """Generate the hostname, times (in nanoseconds), and positions of
+    each host in an ephemeris file, as `db_series`. Unknown positions
+    and positions equal to the previous one are skipped."""
+
+    times, hosts, lat, lon, alt = load_ephemeris(path)
+    values = np.stack([lat, lon, alt], axis=-1)
+    for i, host in enumerate(hosts):
+        pos = values[:, i]
+        keep = ~np.isnan(pos).any(axis=1)
+        keep[1:] &= (pos[1:] != pos[:-1]).any(axis=1)
+        yield host, times[keep], pos[keep]
+
+
+def delays_file(config):
+    """Get the default name of the delays file of a configuration."""
+
+    return f"{config['system']['db']['name']}.delays.npy"
+
+
+def delays_shape(count, n, pairs=None):
+    """Get the shape of the delays saved by `save_delays`."""
+
+    return (count, n, n) if pairs is None else (count, len(pairs[0]))
+
+
+def delays_hash(config, pairs=None):
+    """Get a content hash of the inputs of the delays of a configuration:
+    hostnames, TLE lines of satellites, coordinates of stations, start
+    and step of the time grid, and linked pairs (the delays of a time
+    step do not depend on the number of time steps)."""
+
+    start, step, _ = orbits_ticks(config)
+    content = [f'{nanoseconds(start)}\n{nanoseconds(step)}']
+    for satellite in config['satellites']:
+        content.append(f"{satellite['hostname']}\n{satellite['tle1']}\n"
+                       f"{satellite['tle2']}")
+    for station in config['stations']:
+        content.append(f"{station['hostname']}\n{station['lat']}\n"
+                       f"{station['lon']}\n{station['alt']}")
+    if pairs is not None:
+        content.append(' '.join(map(str, np.concatenate(pairs).tolist())))
+    return hashlib.sha1('\n'.join(content).encode()).hexdigest()
+
+
+def saved_delays(path, digest, shape):
+    """Get the number of time steps of the delays saved at `path` that are
+    still valid, given the content hash and shape (as `delays_shape`) of
+    the delays to save: zero if the file is missing or was saved with a
+    different hash or number of hosts or pairs."""
+
+    try:
+        with open(f'{path}.hash') as f:
+            saved_digest = f.read().strip()
+        delays = np.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        return 0
+
+    if saved_digest != digest or delays.shape[1:] != shape[1:]:
+        return 0
+    return min(len(delays), shape[0])
+
+
+def save_delays(path, positions, pairs=None, first=0, digest=None,
+                chunk=100):
+    """Save line-of-sight delays between hosts at each time step.
+
+    Positions are ECEF coordinates with shape (T, N, 3). Delays (in
+    seconds, NaN for no line of sight) are saved as a float32 array in
+    NumPy format: with shape (T, N, N) indexed by [tick, src, dst] for
+    all pairs of hosts or, if linked `pairs` are given, with shape
+    (T, P) indexed by [tick, pair] (delays are symmetric). Positions
+    (which may be memory-mapped) are read and delays are written in
+    chunks of `chunk` time steps.
+
+    With `first`, positions start at that time step and the delays of
+    previous time steps are copied from the file already at `path`. The
+    content hash `digest` of the inputs, if given, is saved next to the
+    delays (for `saved_delays`).
+    """
+
+    count, n, _ = positions.shape
+    count += first
+    shape = delays_shape(count, n, pairs)
+    saved = np.load(path, mmap_mode='r') if first else None
+    if saved is not None and saved.shape == shape and first == count:
+        return  # nothing to update
+
+    # write to a new file, replacing the previous one when complete
+    temp = f'{path}.tmp'
+    delays = np.lib.format.open_memmap(temp, mode='w+', dtype=np.float32,
+                                       shape=shape)
+    for begin in range(0, first, chunk):
+        delays[begin:min(begin+chunk, first)] = \
+            saved[begin:min(begin+chunk, first)]
+    for begin in range(first, count, chunk):
+        for tick, pos in enumerate(
+                np.asarray(positions[begin-first:begin-first+chunk]), begin):
+            if pairs is None:
+                delays[tick] = sight_latencies(pos)
+            else:
+                delays[tick] = link_latencies(pos, pairs)
+        delays.flush()
+    del delays, saved
+    os.replace(temp, path)
+
+    if digest:
+        with open(f'{path}.hash', 'w') as f:
+            f.write(f'{digest}\n')
+
+
+def load_delays(path, count, n, pairs=None):
+    """Memory-map the delays saved by `save_delays`.
+
+    Returns None if the file is missing or if its shape does not match
+    the given number of time steps and hosts (or linked pairs).
+    """
 
-    if src not in pos:
-        raise ValueError(f'Host {src} not found in orbits timeseries')
+    try:
+        delays = np.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        return None
 
-    return {dst: sight_latency(pos[src], pos[dst])
-            for dst in pos if dst != src}
+    shape = delays_shape(count, n, pairs)
+    if delays.shape != shape:
+        logger.warning(f'Ignoring delays in {path}: shape {delays.shape} '
+                       f'instead of {shape}')
+        return None
+    return delays
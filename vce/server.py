@@ -1,17 +1,37 @@
 """VCE server (running on a dedicated VM)."""
 
+import asyncio
+import json
 import logging
+import os
+import signal
+import socket
+import struct
+import threading
 import responder
+import uvicorn
 import click
-from datetime import datetime, timedelta
+import numpy as np
+from datetime import datetime
 from itertools import chain
-from .orbits import get_delays
-from .utils import parse, db_client
+from .orbits import orbits_ticks, load_positions, ecef_array, \
+    pair_latencies, sight_latencies, delays_file, load_delays, \
+    interpolate_positions, link_pairs, ephemeris_series, grid_positions, \
+    load_contacts, contact_latencies, nanoseconds
+from .utils import parse, db_client, get_links
 
 
 logger = logging.getLogger(__name__)
 api = responder.API()
-db, hosts, sim_start, orbits_start, orbits_end = [None]*5
+hosts, positions, delays, sim_start, tick_step, ticks, substeps = [None]*7
+links, columns, pairs, contacts, orbits_start_ns = [None]*5
+
+#: Serialized responses of the current time step, by (tick, src)
+cache, cache_lock = {}, threading.Lock()
+cache_stats = {'hits': 0, 'misses': 0}
+
+#: Schedules of network parameters, by src (computed once per source)
+schedules = {}
 
 
 @click.group()
@@ -22,46 +42,424 @@ def server():
 
 @server.command()
 @click.argument('config', type=click.File('r'))
-def run(config):
+@click.option('--delays', 'delays_path', type=click.Path(), default=None,
+              help='Delays file (default: <db name>.delays.npy)')
+@click.option('--ephemeris', type=click.Path(exists=True), default=None,
+              help='Read positions from an exported ephemeris file.')
+@click.option('--contacts', 'contacts_path', type=click.Path(exists=True),
+              default=None,
+              help='Decide reachability from `vce orbits contacts` windows.')
+@click.option('--substeps', 'substep_count', type=click.IntRange(min=1),
+              default=1,
+              help='Interpolated positions per orbits step.')
+@click.option('--address', default='0.0.0.0', help='Bind address.')
+@click.option('--port', type=int, default=8888, help='Bind port.')
+@click.option('--workers', type=click.IntRange(min=1), default=1,
+              help='Number of worker processes.')
+@click.option('--debug/--no-debug', default=True,
+              help='Run in debug mode (single worker only).')
+def run(config, delays_path, ephemeris, contacts_path, substep_count,
+        address, port, workers, debug):
     """Run the VCE control server.
 
-    This command starts an HTTP server providing constellation
-    parameters from a timeseries database.
+    This command memory-maps the delays saved by `vce orbits compute`
+    (or loads constellation positions from an ephemeris file, if given,
+    or from a timeseries database if delays are not available) and
+    starts an HTTP server providing network parameters. With more than
+    one substep, positions are loaded and interpolated between orbits
+    steps.
+
+    With contact windows, hosts are reachable only within a window at
+    the time of each step, with delays from the distance between them.
+
+    With more than one worker, orbits data is loaded once and shared
+    by worker processes forked after loading (each worker keeps its
+    own response cache).
     """
+    if debug and workers > 1:
+        raise click.UsageError('Use --no-debug with multiple workers')
+    if delays_path and ephemeris:
+        raise click.UsageError('Use either --delays or --ephemeris')
     config = parse(config)
 
     # setup read-only global variables for API requests
-    global db, hosts, sim_start, orbits_start, orbits_end
-    db = db_client(config)
+    global hosts, positions, delays, sim_start, tick_step, ticks, substeps
+    global links, columns, pairs, contacts, orbits_start_ns
+    substeps = substep_count
     hosts = [node['hostname'] for node in
              chain(config['satellites'], config['stations'])]
+
+    # destinations of each host (all others, or declared links) and
+    # their columns in the delays of linked pairs
+    pairs = link_pairs(hosts, get_links(config))
+    if pairs is None:
+        links = [np.delete(np.arange(len(hosts)), i)
+                 for i in range(len(hosts))]
+    else:
+        i, j = np.concatenate(pairs), np.concatenate(pairs[::-1])
+        column = np.tile(np.arange(len(pairs[0])), 2)
+        order = [np.flatnonzero(i == k)[np.argsort(j[i == k])]
+                 for k in range(len(hosts))]
+        links = [j[o] for o in order]
+        columns = [column[o] for o in order]
+    orbits_start, orbits_step, count = orbits_ticks(config)
+    tick_step = orbits_step / substeps
+    ticks = (count - 1)*substeps + 1
+    if contacts_path:
+        contacts = load_contacts(contacts_path, hosts)
+        orbits_start_ns = nanoseconds(orbits_start)
+    elif substeps == 1 and not ephemeris:
+        delays = load_delays(delays_path or delays_file(config),
+                             count, len(hosts), pairs)
+    if delays is None and ephemeris:
+        positions = ecef_array(*grid_positions(ephemeris_series(ephemeris),
+                                               hosts, orbits_start,
+                                               orbits_step, count))
+    elif delays is None:
+        positions = ecef_array(*load_positions(db_client(config), hosts,
+                                               orbits_start, orbits_step,
+                                               count))
     sim_start = datetime.now()
-    orbits_start = config['system']['orbits']['start']
-    orbits_end = (orbits_start +
-                  timedelta(minutes=config['system']['orbits']['duration']))
 
     # start listening to incoming requests
-    api.run(address='0.0.0.0', port=8888, debug=True, log_level=logger.level)
+    if workers == 1:
+        api.run(address=address, port=port, debug=debug,
+                log_level=logger.level)
+    else:
+        serve(address, port, workers)
+
+
+def serve(address, port, workers):
+    """Serve requests from worker processes sharing a listening socket.
+
+    Workers are forked after loading orbits data, so that its memory
+    pages are shared with the parent process.
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((address, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            uvicorn.run(api, fd=sock.fileno(), log_level=logger.level)
+            os._exit(0)
+        children.append(pid)
+    logger.info(f'Started {workers} workers on {address}:{port}')
+
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+
+def current_tick():
+    """Get the index of the current time step (orbits substep)."""
+
+    # stop orbit propagation after the last time step
+    tick = (datetime.now() - sim_start) // tick_step
+    return min(tick, ticks - 1)
+
+
+def get_positions(tick):
+    """Get the positions of all hosts at a time step, interpolated
+    between orbits steps when using substeps."""
+
+    if substeps == 1:
+        return positions[tick]
+    return interpolate_positions(positions, tick / substeps)
+
+
+def get_matrix(tick):
+    """Get delays (in seconds) between all hosts."""
+
+    if delays is not None and pairs is None:
+        return delays[tick]
+    if delays is not None:
+        matrix = np.full((len(hosts), len(hosts)), np.nan)
+        np.fill_diagonal(matrix, 0.0)
+        i, j = pairs
+        matrix[i, j] = matrix[j, i] = delays[tick]
+        return matrix
+    if contacts is not None:
+        matrix = np.full((len(hosts), len(hosts)), np.nan)
+        np.fill_diagonal(matrix, 0.0)
+        for i in range(len(hosts)):
+            dst, latency = get_delays(tick, i)
+            matrix[i, dst] = latency
+        return matrix
+    return sight_latencies(get_positions(tick), pairs)
+
+
+def get_delays(tick, i):
+    """Get the destinations of the i-th host (all other hosts, or linked
+    hosts) and delays (in seconds) to them."""
+
+    if delays is not None:
+        return links[i], link_delays(tick, i)
+
+    pos = get_positions(tick)
+    if np.isnan(pos[i, 0]):
+        raise ValueError(f'Host {hosts[i]} not found in orbits timeseries')
+    if contacts is not None:
+        t = orbits_start_ns + nanoseconds(tick*tick_step)
+        return links[i], contact_latencies(contacts, pos, i, links[i], t)
+    return links[i], pair_latencies(pos[i], pos[links[i]])
+
+
+def link_delays(tick, i):
+    """Get the delays (in seconds) from the i-th host to its destinations
+    in the delays file, at a time step (or a slice of time steps)."""
+
+    if pairs is None:
+        return delays[tick, i, links[i]]
+    return delays[tick, columns[i]]
+
+
+def get_params(tick, src):
+    """Get network parameters for a source at a given time step."""
+
+    params = {}
+    for j, delay in zip(*get_delays(tick, hosts.index(src))):
+        if np.isnan(delay):
+            # drop all packets if unreachable
+            params[hosts[j]] = {'loss': 100}
+        elif delay > 0 or pairs is not None:
+            # set delay for reachable destinations (also zero delays of
+            # declared links, which the agent would drop otherwise)
+            params[hosts[j]] = {'delay': float(delay)*1000}
+
+    return params
+
+
+def get_changes(since, tick, src):
+    """Get network parameters for a source that changed between two time
+    steps (None for destinations without parameters at the later one)."""
+
+    return diff_params(get_params(since, src), get_params(tick, src))
+
+
+def diff_params(old_params, params):
+    """Get the destinations with parameters that differ between two sets
+    of network parameters (None for destinations removed)."""
+
+    changes = {dst: None for dst in old_params if dst not in params}
+    changes.update((dst, config) for dst, config in params.items()
+                   if old_params.get(dst) != config)
+    return changes
+
+
+def get_schedule(src):
+    """Get the network parameters for a source at all time steps, as a
+    list of time steps and changes (all parameters at time step 0).
+
+    Schedules are computed once for each source. With a delays file,
+    parameters are evaluated only at the time steps where the delays
+    of the source change.
+    """
+
+    with cache_lock:
+        schedule = schedules.get(src)
+    if schedule is not None:
+        return schedule
+
+    if delays is not None:
+        values = link_delays(slice(None), hosts.index(src))
+        same = (values[1:] == values[:-1]) | \
+            (np.isnan(values[1:]) & np.isnan(values[:-1]))
+        steps = [0] + (np.flatnonzero(~same.all(axis=1)) + 1).tolist()
+    else:
+        steps = range(ticks)
+
+    schedule, old_params = [], {}
+    for tick in steps:
+        params = get_params(tick, src)
+        changes = diff_params(old_params, params)
+        if changes or tick == 0:
+            schedule.append([tick, changes])
+        old_params = params
+
+    with cache_lock:
+        schedules[src] = schedule
+    return schedule
+
+
+def cached(key, serialize):
+    """Get a response body from the cache, or serialize and cache it.
+    The first element of the key is the time step of the response.
+    Bodies are serialized without holding the lock (concurrent misses
+    of the same key may serialize it more than once)."""
+
+    with cache_lock:
+        body = cache.get(key)
+        if body is not None:
+            cache_stats['hits'] += 1
+            return body
+        cache_stats['misses'] += 1
+
+    body = serialize()
+
+    with cache_lock:
+        # evict responses of previous time steps (and skip responses
+        # of a time step that ended while serializing)
+        current = next(iter(cache))[0] if cache else key[0]
+        if current < key[0]:
+            cache.clear()
+        if current <= key[0]:
+            cache[key] = body
+    return body
+
+
+def get_body(tick, src, since=None):
+    """Get the serialized network parameters for a source (or only their
+    changes since a previous time step), reusing responses cached for
+    the same time step."""
+
+    if since is None:
+        return cached((tick, src, since),
+                      lambda: json.dumps(get_params(tick, src)).encode())
+    return cached((tick, src, since),
+                  lambda: json.dumps(get_changes(since, tick, src)).encode())
+
+
+def get_all_body(tick, binary=False):
+    """Get the serialized delays (in milliseconds) between all hosts.
+
+    The binary format is a little-endian uint32 header length, a JSON
+    header with the time step and the list of hosts, and the float32
+    delay matrix in row-major order (NaN for unreachable destinations).
+    The JSON format has the same fields, plus delay (null if
+    unreachable) and loss (100 if unreachable) matrices.
+    """
+
+    def serialize():
+        matrix = np.asarray(get_matrix(tick), dtype='<f4')*1000
+        if binary:
+            header = json.dumps({'tick': tick, 'hosts': hosts}).encode()
+            return struct.pack('<I', len(header)) + header + matrix.tobytes()
+        unreachable = np.isnan(matrix)
+        return json.dumps({
+            'tick': tick,
+            'hosts': hosts,
+            'delay': np.where(unreachable, None, matrix).tolist(),
+            'loss': np.where(unreachable, 100, 0).tolist()
+        }).encode()
+
+    return cached((tick, None, 'bin' if binary else 'json'), serialize)
+
+
+def parse_version(version):
+    """Get the time step of a version (ETag) sent by a client."""
+
+    try:
+        tick = int(version.strip().strip('W/').strip('"'))
+    except (AttributeError, ValueError):
+        return None
+    return tick if 0 <= tick < ticks else None
 
 
 @api.route('/net/src/{src}')
 def respond(req, resp, *, src):
-    """Respond to HTTP requests with network parameters for a source."""
+    """Respond to HTTP requests with network parameters for a source.
+
+    The version (time step) of the parameters is sent in the ETag
+    header: requests with a matching If-None-Match header receive 304
+    (Not Modified) if parameters did not change since that version,
+    and requests with a `since` version receive only the destinations
+    with changed parameters (null if removed), with a Delta-Base header.
+    """
     if src not in hosts:
         resp.status_code = 404
         return
 
-    # stop orbit propagation after orbits_end
-    t = orbits_start + (datetime.now() - sim_start)
-    t = min(t, orbits_end)
+    tick = current_tick()
+    resp.headers['ETag'] = f'"{tick}"'
+
+    held = parse_version(req.headers.get('If-None-Match'))
+    if held is not None and (held == tick or
+                             get_body(tick, src, held) == b'{}'):
+        resp.status_code = 304
+        return
+
+    since = parse_version(req.params.get('since'))
+    if since is not None:
+        resp.headers['Delta-Base'] = f'"{since}"'
+    resp.content = get_body(tick, src, since)
+    resp.mimetype = 'application/json'
+
+
+@api.route('/net/all')
+def respond_all(req, resp):
+    """Respond to HTTP requests with network parameters between all
+    hosts, in JSON or binary format (with `format=bin`)."""
+    tick = current_tick()
+    resp.headers['ETag'] = f'"{tick}"'
+    if parse_version(req.headers.get('If-None-Match')) == tick:
+        resp.status_code = 304
+        return
+
+    binary = req.params.get('format') == 'bin'
+    resp.content = get_all_body(tick, binary)
+    resp.mimetype = 'application/octet-stream' if binary \
+        else 'application/json'
+
+
+@api.route('/net/src/{src}/stream')
+async def respond_stream(req, resp, *, src):
+    """Push network parameters for a source as server-sent events,
+    sending a new event only when parameters change."""
+    if src not in hosts:
+        resp.status_code = 404
+        return
+
+    resp.headers['Content-Type'] = 'text/event-stream'
+    resp.headers['Cache-Control'] = 'no-cache'
+
+    @resp.stream
+    async def events():
+        last_body = None
+        while True:
+            tick = current_tick()
+            body = get_body(tick, src)
+            if body != last_body:
+                yield f'id: "{tick}"\ndata: '.encode() + body + b'\n\n'
+                last_body = body
+            else:
+                yield b': keepalive\n\n'
+
+            # wait for the next time step (or keepalive interval)
+            next_tick = sim_start + (tick + 1)*tick_step
+            wait = (next_tick - datetime.now()).total_seconds()
+            if tick == ticks - 1:
+                wait = tick_step.total_seconds()
+            await asyncio.sleep(max(wait, 0.01))
+
+
+@api.route('/net/src/{src}/schedule')
+def respond_schedule(req, resp, *, src):
+    """Respond with the network parameters for a source at all time
+    steps: the start time (seconds since the epoch) and duration (in
+    seconds) of time steps, their number, and the list of changes."""
+    if src not in hosts:
+        resp.status_code = 404
+        return
+
+    resp.media = {
+        'start': sim_start.timestamp(),
+        'step': tick_step.total_seconds(),
+        'ticks': ticks,
+        'changes': get_schedule(src)
+    }
 
-    params = {}
-    for dst, delay in get_delays(db, t, src).items():
-        if delay is None:
-            # drop all packets if unreachable
-            params[dst] = {'loss': 100}
-        elif delay > 0:
-            # set delay for reachable destinations
-            params[dst] = {'delay': delay*1000}
 
-    resp.media = params
+@api.route('/cache')
+def cache_info(req, resp):
+    """Respond with hit and miss counters of the response cache."""
+    with cache_lock:
+        resp.media = dict(cache_stats, size=len(cache))
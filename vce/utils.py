@@ -113,6 +113,27 @@ def assign_ip_addr(config):
     return config
 
 
+def get_links(config):
+    """Get the set of hostnames linked to each satellite and base
+    station by their `links` (links are bidirectional), or None if no
+    links are declared (all nodes are linked)."""
+
+    nodes = list(chain(config['satellites'], config['stations']))
+    if not any('links' in node for node in nodes):
+        return None
+
+    links = {node['hostname']: set() for node in nodes}
+    for node in nodes:
+        for dst in node.get('links', []):
+            if dst not in links:
+                raise ValueError(f"Unknown host {dst} in links of "
+                                 f"{node['hostname']}")
+            links[node['hostname']].add(dst)
+            links[dst].add(node['hostname'])
+
+    return links
+
+
 def parse(yaml, get_data=True):
     """Parse the input YAML configuration of the constellation."""
 
@@ -149,6 +170,25 @@ def host_alias(hostname):
     return alias.get(hostname, hostname)
 
 
+def host_addresses(config):
+    """Get the ip address of each node (server, satellite, base station)
+    by hostname: the address assigned in the configuration or, for
+    hostnames with an alias (e.g., local testing), the address of the
+    alias (omitted if it cannot be resolved)."""
+
+    addresses = {}
+    for node in chain([config['system']['server']], config['satellites'],
+                      config['stations']):
+        hostname = node['hostname']
+        if host_alias(hostname) == hostname:
+            addresses[hostname] = node['ip']
+        else:
+            addr = get_addr(hostname)
+            if addr:
+                addresses[hostname] = addr
+    return addresses
+
+
 def get_iface(addr):
     """Find the interface where a given source ip is used."""
 